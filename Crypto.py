@@ -1,4 +1,12 @@
 import binascii
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
 
 def LoadUInt32BE(buffer, offset):
   """Loads a 32-bit unsigned integer from a buffer in big-endian format.
@@ -36,12 +44,12 @@ def getRndEcd(index, rnd):
         A 32-bit unsigned integer.
     """
 
-    rnd = rnd * LoadUInt32BE(rndBufEcd, 8 * index) + LoadUInt32BE(rndBufEcd, 8 * index + 4)
+    rnd = (rnd * LoadUInt32BE(rndBufEcd, 8 * index) + LoadUInt32BE(rndBufEcd, 8 * index + 4)) & 0xFFFFFFFF
     return rnd
 
 
 def CreateXorkeyExf(header):
-  """Creates an XOR key for the ECD decryptor.
+  """Creates an XOR key for the EXF decryptor.
 
   Args:
     header: The header of the encrypted file.
@@ -51,35 +59,62 @@ def CreateXorkeyExf(header):
   """
 
   keyBuffer = bytearray(16)
-  index = int.from_bytes(header[4:6], "big")
-  tempVal = int.from_bytes(header[12:16], "big")
-  value = int.from_bytes(header[12:16], "big")
+  index = int.from_bytes(header[4:6], "little")
+  tempVal = int.from_bytes(header[12:16], "little")
+  value = int.from_bytes(header[12:16], "little")
 
   for i in range(4):
-    tempVal = tempVal * LoadUInt32BE(rndBufExf, index * 8) + LoadUInt32BE(rndBufExf, index * 8 + 4)
+    tempVal = (tempVal * LoadUInt32BE(rndBufExf, index * 8) + LoadUInt32BE(rndBufExf, index * 8 + 4)) & 0xFFFFFFFF
     key = tempVal ^ value
-    tempKey = key.to_bytes(4, "big")
-    keyBuffer.extend(tempKey)
+    keyBuffer[i * 4:i * 4 + 4] = key.to_bytes(4, "little")
 
   return keyBuffer
 
+def EcdPayloadSize(buffer):
+  """Reads the payload size from an ECD header and checks the buffer holds it.
+
+  Args:
+    buffer: A buffer containing the encrypted file.
+
+  Returns:
+    The payload size (fsize) from the header.
+
+  Raises:
+    ValueError: If the buffer is shorter than the header and the payload it claims.
+  """
+
+  if len(buffer) < 16:
+    raise ValueError(f"ECD file of {len(buffer)} bytes is shorter than its header")
+  fsize = int.from_bytes(buffer[8:12], "little")
+  if 16 + fsize > len(buffer):
+    raise ValueError(f"ECD header claims {fsize} bytes of payload, but only {len(buffer) - 16} follow it")
+  return fsize
+
 def decEcd(buffer):
   """Decrypts a file encrypted using the ECD algorithm.
 
   Args:
-    buffer: A byte buffer containing the encrypted file.
+    buffer: A writable buffer (bytearray, mmap, memoryview) containing the
+      encrypted file. It is decrypted in place.
+
+  Returns:
+    A memoryview of the decrypted payload.
+
+  Raises:
+    ValueError: If the buffer is shorter than the payload size in the header.
   """
 
-  fsize = int.from_bytes(buffer[8:12], "big")
-  crc32 = int.from_bytes(buffer[12:16], "big")
-  index = int.from_bytes(buffer[4:6], "big")
-  rnd = (crc32 << 16) | (crc32 >> 16) | 1
+  fsize = EcdPayloadSize(buffer)
+  crc32 = int.from_bytes(buffer[12:16], "little")
+  index = int.from_bytes(buffer[4:6], "little")
+  rnd = ((crc32 << 16) | (crc32 >> 16) | 1) & 0xFFFFFFFF
 
-  xorpad = getRndEcd(index, rnd)
-  r8 = xorpad
+  rnd = getRndEcd(index, rnd)
+  r8 = rnd & 0xFF
 
   for i in range(fsize):
-    xorpad = getRndEcd(index, rnd)
+    rnd = getRndEcd(index, rnd)
+    xorpad = rnd
 
     data = buffer[0x10 + i]
     r11 = data ^ r8
@@ -94,8 +129,183 @@ def decEcd(buffer):
     r8 = (r12 & 0xF) | ((r11 & 0xF) << 4)
     buffer[0x10 + i] = r8
 
-def encEcd(buffer, bufferMeta):
-  """Encrypts a file using the ECD algorithm.
+  return memoryview(buffer)[0x10:0x10 + fsize]
+
+def _ecdRounds(r11, r12, xorpad):
+  """Runs the eight ECD nibble-mixing rounds.
+
+  Args:
+    r11: The initial r11 register.
+    r12: The initial r12 register.
+    xorpad: The xorpad for the current byte.
+
+  Returns:
+    The mixed byte.
+  """
+
+  for j in range(8):
+    r10 = xorpad ^ r11
+    r11 = r12
+    r12 = (r12 ^ r10) & 0xFF
+    xorpad >>= 4
+
+  return (r12 & 0xF) | ((r11 & 0xF) << 4)
+
+# The mixing rounds are linear over GF(2), so the byte they produce splits into
+# a fixed transform of (data ^ r8) and a keystream byte that only depends on
+# the xorpad. The transform is its own inverse, so encryption uses it as well.
+_ecdTables = None
+
+def GetEcdTables():
+  """Builds the lookup tables used by the table-driven ECD engine.
+
+  The tables are built on first use and shared by every file.
+
+  Returns:
+    A tuple of the 256-entry byte transform and the two 65536-entry keystream
+    tables for the low and high halves of the xorpad.
+  """
+
+  global _ecdTables
+  if _ecdTables is None:
+    transform = bytes(_ecdRounds(c, c >> 4, 0) for c in range(256))
+    nibbles = [[_ecdRounds(0, 0, n << (4 * j)) for n in range(16)] for j in range(8)]
+    lo = bytearray(1)
+    hi = bytearray(1)
+    for j in range(4):
+      lo = bytearray(b ^ n for n in nibbles[j] for b in lo)
+      hi = bytearray(b ^ n for n in nibbles[j + 4] for b in hi)
+    _ecdTables = (transform, bytes(lo), bytes(hi))
+  return _ecdTables
+
+def EcdSeed(index, crc32):
+  """Returns the ECD generator state after the header step.
+
+  Args:
+    index: The key index from the ECD header.
+    crc32: The CRC32 from the ECD header.
+
+  Returns:
+    The generator state; its low byte is the initial r8 value.
+  """
+
+  return getRndEcd(index, ((crc32 << 16) | (crc32 >> 16) | 1) & 0xFFFFFFFF)
+
+def EcdKeystream(index, rnd, length):
+  """Precomputes a run of the ECD keystream.
+
+  Args:
+    index: The key index from the ECD header.
+    rnd: The generator state before the first byte.
+    length: The number of keystream bytes to generate.
+
+  Returns:
+    A tuple of the generator state after the last byte and a bytearray with
+    one keystream byte per payload byte.
+  """
+
+  transform, lo, hi = GetEcdTables()
+  mul = LoadUInt32BE(rndBufEcd, 8 * index)
+  inc = LoadUInt32BE(rndBufEcd, 8 * index + 4)
+
+  keystream = bytearray(length)
+  for i in range(length):
+    rnd = (rnd * mul + inc) & 0xFFFFFFFF
+    keystream[i] = lo[rnd & 0xFFFF] ^ hi[rnd >> 16]
+
+  return rnd, keystream
+
+def XorBytes(a, b):
+  """XORs two equally sized byte buffers.
+
+  Args:
+    a: A byte buffer.
+    b: A byte buffer.
+
+  Returns:
+    A bytes object holding a ^ b.
+  """
+
+  return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+def EncryptEcdChunk(data, keystream, r8):
+  """Encrypts a run of ECD payload bytes.
+
+  Args:
+    data: The plaintext bytes.
+    keystream: The keystream bytes for data, see EcdKeystream.
+    r8: The plaintext byte preceding data, or the initial r8 value.
+
+  Returns:
+    A tuple of the ciphertext bytes and the r8 value for the next run.
+  """
+
+  if len(data) == 0:
+    return b"", r8
+
+  # c = T[data ^ k] ^ previous data
+  data = bytes(data)
+  out = XorBytes(XorBytes(data, keystream).translate(GetEcdTables()[0]), bytes([r8]) + data[:-1])
+  return out, data[-1]
+
+def DecryptEcdChunk(data, keystream, r8):
+  """Decrypts a run of ECD payload bytes.
+
+  Args:
+    data: The ciphertext bytes.
+    keystream: The keystream bytes for data, see EcdKeystream.
+    r8: The plaintext byte preceding data, or the initial r8 value.
+
+  Returns:
+    A tuple of the plaintext bytes and the r8 value for the next run.
+  """
+
+  transform = GetEcdTables()[0]
+
+  # data = T[c ^ r8] ^ k = (T[c] ^ k) ^ T[r8]
+  pre = XorBytes(bytes(data).translate(transform), keystream)
+  out = bytearray(len(pre))
+  for i, v in enumerate(pre):
+    r8 = v ^ transform[r8]
+    out[i] = r8
+
+  return out, r8
+
+def decEcdTable(buffer):
+  """Decrypts a file encrypted using the ECD algorithm with lookup tables.
+
+  Produces the same output as decEcd, but replaces the per-byte mixing rounds
+  with a precomputed keystream and a single table lookup per byte.
+
+  Args:
+    buffer: A writable buffer (bytearray, mmap, memoryview) containing the
+      encrypted file. It is decrypted in place.
+
+  Returns:
+    A memoryview of the decrypted payload.
+
+  Raises:
+    ValueError: If the buffer is shorter than the payload size in the header.
+  """
+
+  fsize = EcdPayloadSize(buffer)
+  crc32 = int.from_bytes(buffer[12:16], "little")
+  index = int.from_bytes(buffer[4:6], "little")
+
+  rnd = EcdSeed(index, crc32)
+  r8 = rnd & 0xFF
+  rnd, keystream = EcdKeystream(index, rnd, fsize)
+  buffer[0x10:0x10 + fsize], r8 = DecryptEcdChunk(buffer[0x10:0x10 + fsize], keystream, r8)
+
+  return memoryview(buffer)[0x10:0x10 + fsize]
+
+ecdDecoders = {
+  "reference": decEcd,
+  "table": decEcdTable,
+}
+
+def encEcdReference(buffer, bufferMeta):
+  """Encrypts a file using the ECD algorithm, one byte at a time.
 
   Args:
     buffer: A byte buffer containing the file to be encrypted.
@@ -108,25 +318,22 @@ def encEcd(buffer, bufferMeta):
   # Update meta data
   fsize = len(buffer)
   crc32w = binascii.crc32(buffer)
-  index = int.from_bytes(bufferMeta[4:6], "big")
+  index = int.from_bytes(bufferMeta[4:6], "little")
 
   # Write meta data
   buf = bytearray(16 + fsize)
-  buf.extend(bufferMeta)
-  buf.extend(fsize.to_bytes(4, "big"))
-  buf.extend(crc32w.to_bytes(4, "big"))
-
-  # Fill data with nullspace
-  for i in range(16 + fsize, len(buf)):
-    buf[i] = 0
+  buf[:16] = bufferMeta[:16]
+  buf[8:12] = fsize.to_bytes(4, "little")
+  buf[12:16] = crc32w.to_bytes(4, "little")
 
   # Encrypt data
-  rnd = (crc32w << 16) | (crc32w >> 16) | 1
-  xorpad = getRndEcd(index, rnd)
-  r8 = xorpad
+  rnd = ((crc32w << 16) | (crc32w >> 16) | 1) & 0xFFFFFFFF
+  rnd = getRndEcd(index, rnd)
+  r8 = rnd & 0xFF
 
   for i in range(fsize):
-    xorpad = getRndEcd(index, rnd)
+    rnd = getRndEcd(index, rnd)
+    xorpad = rnd
     data = buffer[i]
     r11 = 0
     r12 = 0
@@ -151,15 +358,293 @@ def encEcd(buffer, bufferMeta):
 
   return buf
 
-def decExf(buffer):
-  """Decrypts a file encrypted using the EXF algorithm.
+# Block size used by the NumPy backend; bounds the size of its temporaries.
+ECD_NUMPY_BLOCK = 1 << 20
+
+_ecdJumps = {}
+
+def GetEcdJumps(index):
+  """Builds the jump-ahead constants of the ECD generator for a key index.
+
+  Stepping the generator i + 1 times from rnd gives A[i] * rnd + B[i], so a
+  whole block of xorpads can be computed with two array operations.
+
+  Args:
+    index: The key index from the ECD header.
+
+  Returns:
+    A tuple of two uint32 arrays (A, B) of length ECD_NUMPY_BLOCK.
+  """
+
+  if index not in _ecdJumps:
+    mul = LoadUInt32BE(rndBufEcd, 8 * index)
+    inc = LoadUInt32BE(rndBufEcd, 8 * index + 4)
+    a = np.empty(ECD_NUMPY_BLOCK, dtype=np.uint32)
+    b = np.empty(ECD_NUMPY_BLOCK, dtype=np.uint32)
+    a[0] = mul
+    b[0] = inc
+
+    # Double the filled prefix, composing it with the generator stepped m times.
+    m = 1
+    while m < ECD_NUMPY_BLOCK:
+      k = min(m, ECD_NUMPY_BLOCK - m)
+      am = a[m - 1]
+      bm = b[m - 1]
+      a[m:m + k] = a[:k] * am
+      b[m:m + k] = b[:k] * am + bm
+      m += k
+
+    _ecdJumps[index] = (a, b)
+  return _ecdJumps[index]
+
+def EcdKeystreamNumpy(index, rnd, length):
+  """Precomputes a run of the ECD keystream using NumPy.
+
+  Args:
+    index: The key index from the ECD header.
+    rnd: The generator state before the first byte.
+    length: The number of keystream bytes to generate.
+
+  Returns:
+    A tuple of the generator state after the last byte and a uint8 array with
+    one keystream byte per payload byte.
+  """
+
+  transform, lo, hi = GetEcdTables()
+  lo = np.frombuffer(lo, dtype=np.uint8)
+  hi = np.frombuffer(hi, dtype=np.uint8)
+  a, b = GetEcdJumps(index)
+
+  keystream = np.empty(length, dtype=np.uint8)
+  for pos in range(0, length, ECD_NUMPY_BLOCK):
+    n = min(ECD_NUMPY_BLOCK, length - pos)
+    xorpads = a[:n] * np.uint32(rnd) + b[:n]
+    rnd = int(xorpads[-1])
+    np.bitwise_xor(lo[xorpads & 0xFFFF], hi[xorpads >> 16], out=keystream[pos:pos + n])
+
+  return rnd, keystream
+
+def EncryptEcdChunkNumpy(data, keystream, r8, out):
+  """Encrypts a run of ECD payload bytes using NumPy.
+
+  Args:
+    data: A uint8 array with the plaintext bytes.
+    keystream: A uint8 array with the keystream bytes for data.
+    r8: The plaintext byte preceding data, or the initial r8 value.
+    out: A uint8 array receiving the ciphertext bytes.
+
+  Returns:
+    The r8 value for the next run.
+  """
+
+  if len(data) == 0:
+    return r8
+
+  transform = np.frombuffer(GetEcdTables()[0], dtype=np.uint8)
+  np.take(transform, data ^ keystream, out=out)
+  out[0] ^= r8
+  out[1:] ^= data[:-1]
+  return int(data[-1])
+
+def DecryptEcdChunkNumpy(data, keystream, r8, out):
+  """Decrypts a run of ECD payload bytes using NumPy.
+
+  Each plaintext byte is u ^ T[previous plaintext] with u = T[c] ^ k. The
+  transform is its own inverse, so unrolling the chain gives
+  p[i] = A[i] ^ T[A[i - 1]], where A is the running XOR of u over the
+  positions with the same parity, and the whole run is computed in bulk.
+
+  Args:
+    data: A uint8 array with the ciphertext bytes.
+    keystream: A uint8 array with the keystream bytes for data.
+    r8: The plaintext byte preceding data, or the initial r8 value.
+    out: A uint8 array receiving the plaintext bytes.
+
+  Returns:
+    The r8 value for the next run.
+  """
+
+  if len(data) == 0:
+    return r8
+
+  transform = np.frombuffer(GetEcdTables()[0], dtype=np.uint8)
+  u = np.empty(len(data) + 1, dtype=np.uint8)
+  u[0] = r8
+  np.bitwise_xor(transform[data], keystream, out=u[1:])
+
+  acc = np.empty_like(u)
+  np.bitwise_xor.accumulate(u[0::2], out=acc[0::2])
+  np.bitwise_xor.accumulate(u[1::2], out=acc[1::2])
+
+  np.bitwise_xor(acc[1:], transform[acc[:-1]], out=out)
+  return int(out[-1])
+
+def decEcdNumpy(buffer):
+  """Decrypts a file encrypted using the ECD algorithm with NumPy array operations.
+
+  Args:
+    buffer: A writable buffer (bytearray, mmap, memoryview) containing the
+      encrypted file. It is decrypted in place.
+
+  Returns:
+    A memoryview of the decrypted payload.
+
+  Raises:
+    ValueError: If the buffer is shorter than the payload size in the header.
+  """
+
+  fsize = EcdPayloadSize(buffer)
+  crc32 = int.from_bytes(buffer[12:16], "little")
+  index = int.from_bytes(buffer[4:6], "little")
+
+  data = np.frombuffer(memoryview(buffer).cast("B"), dtype=np.uint8)[0x10:0x10 + fsize]
+
+  rnd = EcdSeed(index, crc32)
+  r8 = rnd & 0xFF
+  for pos in range(0, fsize, ECD_NUMPY_BLOCK):
+    end = min(pos + ECD_NUMPY_BLOCK, fsize)
+    rnd, keystream = EcdKeystreamNumpy(index, rnd, end - pos)
+    r8 = DecryptEcdChunkNumpy(data[pos:end], keystream, r8, data[pos:end])
+
+  return memoryview(buffer)[0x10:0x10 + fsize]
+
+if np is not None:
+  ecdDecoders["numpy"] = decEcdNumpy
+
+def encEcdNumpy(buffer, bufferMeta):
+  """Encrypts a file using the ECD algorithm with NumPy array operations.
+
+  Encryption only chains on the previous plaintext byte, so every ciphertext
+  byte is T[data ^ k] ^ previous data and the whole file is computed in bulk.
+
+  Args:
+    buffer: A byte buffer containing the file to be encrypted.
+    bufferMeta: A byte buffer containing the metadata for the encrypted file.
+
+  Returns:
+    A byte buffer containing the encrypted file.
+  """
+
+  fsize = len(buffer)
+  crc32w = binascii.crc32(buffer)
+  index = int.from_bytes(bufferMeta[4:6], "little")
+
+  buf = bytearray(16 + fsize)
+  buf[:16] = bufferMeta[:16]
+  buf[8:12] = fsize.to_bytes(4, "little")
+  buf[12:16] = crc32w.to_bytes(4, "little")
+
+  data = np.frombuffer(buffer, dtype=np.uint8)
+  out = np.frombuffer(buf, dtype=np.uint8)[16:]
+
+  rnd = EcdSeed(index, crc32w)
+  r8 = rnd & 0xFF
+  for pos in range(0, fsize, ECD_NUMPY_BLOCK):
+    end = min(pos + ECD_NUMPY_BLOCK, fsize)
+    rnd, keystream = EcdKeystreamNumpy(index, rnd, end - pos)
+    r8 = EncryptEcdChunkNumpy(data[pos:end], keystream, r8, out[pos:end])
+
+  return buf
+
+ecdEncoders = {
+  "reference": encEcdReference,
+}
+if np is not None:
+  ecdEncoders["numpy"] = encEcdNumpy
+
+def encEcd(buffer, bufferMeta):
+  """Encrypts a file using the ECD algorithm.
+
+  Uses the NumPy backend when NumPy is installed and the pure-Python one
+  otherwise.
 
   Args:
-    buffer: A byte buffer containing the encrypted file.
+    buffer: A byte buffer containing the file to be encrypted.
+    bufferMeta: A byte buffer containing the metadata for the encrypted file.
+
+  Returns:
+    A byte buffer containing the encrypted file.
+  """
+
+  if np is not None:
+    return encEcdNumpy(buffer, bufferMeta)
+  return encEcdReference(buffer, bufferMeta)
+
+# Chunk size used when streaming files through the ECD cipher.
+ECD_CHUNK = 1 << 20
+
+def encEcdFile(inPath, bufferMeta, outPath, chunkSize=ECD_CHUNK):
+  """Encrypts a file using the ECD algorithm without loading it into memory.
+
+  The input is memory-mapped and read twice: once to compute the CRC32 the
+  keystream is seeded from, and once to stream the ciphertext into a
+  preallocated output file. The fsize and crc32 header fields are patched in
+  at the end. The output is written next to outPath and moved into place, so
+  inPath and outPath may be the same file.
+
+  Args:
+    inPath: The path to the file to be encrypted.
+    bufferMeta: A byte buffer containing the metadata for the encrypted file.
+    outPath: The path to the encrypted output file.
+    chunkSize: The number of bytes encrypted per step.
+  """
+
+  fsize = os.path.getsize(inPath)
+  tmpPath = f"{outPath}.tmp"
+
+  replaced = False
+  try:
+    with open(inPath, "rb") as fin, open(tmpPath, "wb") as fout:
+      mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) if fsize else None
+      data = memoryview(mm) if mm is not None else memoryview(b"")
+      try:
+        # Compute the CRC32 incrementally.
+        crc32w = 0
+        for pos in range(0, fsize, chunkSize):
+          crc32w = binascii.crc32(data[pos:pos + chunkSize], crc32w)
+
+        # Preallocate the output and stream the ciphertext into it.
+        fout.truncate(16 + fsize)
+        encryptor = EcdEncryptor(bufferMeta, fsize, crc32w, writeHeader=False)
+        fout.seek(16)
+        for pos in range(0, fsize, chunkSize):
+          fout.write(encryptor.feed(data[pos:pos + chunkSize]))
+        encryptor.flush()
+
+        # Patch the header fields.
+        fout.seek(0)
+        fout.write(encryptor.header)
+      finally:
+        data.release()
+        if mm is not None:
+          try:
+            mm.close()
+          except BufferError:
+            # Only while an exception is propagating, whose traceback still
+            # holds a chunk view; the map is closed when that is freed, and
+            # the original error is not hidden.
+            pass
+
+    os.replace(tmpPath, outPath)
+    replaced = True
+  finally:
+    # Do not leave a partial output behind.
+    if not replaced and os.path.exists(tmpPath):
+      os.remove(tmpPath)
+
+def decExfReference(buffer):
+  """Decrypts a file encrypted using the EXF algorithm, one byte at a time.
+
+  Args:
+    buffer: A writable buffer (bytearray, mmap, memoryview) containing the
+      encrypted file. It is decrypted in place.
+
+  Returns:
+    A memoryview of the decrypted payload.
   """
 
   header = buffer[:16]
-  if int.from_bytes(header[:4], "big") == 0x1a667865:
+  if int.from_bytes(header[:4], "little") == 0x1a667865:
     keybuf = CreateXorkeyExf(header)
     for i in range(16, len(buffer) - len(header)):
       r28 = i - 0x10
@@ -174,4 +659,476 @@ def decExf(buffer):
       r9 ^= r12
       r26 = r5 ^ r4
       r26 = (r26 & ~0xf0) | ((r9 & 0xf) << 4)
-      buffer[i] = r26
\ No newline at end of file
+      buffer[i] = r26 & 0xFF
+
+  return memoryview(buffer)[16:]
+
+def DecryptExfChunk(buffer, pos, keybuf):
+  """Decrypts EXF payload bytes in place, one byte at a time.
+
+  Args:
+    buffer: A writable buffer with the payload bytes to decrypt.
+    pos: The payload position (i - 0x10) of the first byte in buffer.
+    keybuf: The 16-byte key from CreateXorkeyExf.
+  """
+
+  for i in range(len(buffer)):
+    r4 = buffer[i] ^ ((pos + i) & 0xFF)
+    r9 = (r4 >> 4) ^ keybuf[(pos + i) & 0xf]
+    buffer[i] = ((r4 ^ (keybuf[r4 >> 4] >> 4)) & 0xf) | ((r9 & 0xf) << 4)
+
+# Block size used by the NumPy EXF kernel; a multiple of 256.
+EXF_NUMPY_BLOCK = 1 << 20
+
+_exfRamp = None
+
+def CreateTableExf(keybuf):
+  """Creates the EXF lookup table for a key.
+
+  A decrypted byte only depends on the encrypted byte and the low eight bits
+  of its position, so the cipher is a 256 x 256 table indexed by
+  (position & 0xFF) << 8 | byte.
+
+  Args:
+    keybuf: The 16-byte key from CreateXorkeyExf.
+
+  Returns:
+    A uint8 array of 65536 entries.
+  """
+
+  key = np.frombuffer(bytes(keybuf), dtype=np.uint8)
+  pos = np.arange(256, dtype=np.uint8)[:, None]
+  r4 = pos ^ np.arange(256, dtype=np.uint8)[None, :]
+  r9 = (r4 >> 4) ^ key[pos & 0xf]
+  r26 = ((r4 ^ (key[r4 >> 4] >> 4)) & 0xf) | ((r9 & 0xf) << 4)
+  return r26.astype(np.uint8).ravel()
+
+def DecryptExfBlocks(view, pos, table):
+  """Decrypts EXF payload bytes in place with a table from CreateTableExf.
+
+  Args:
+    view: A writable uint8 array over the payload bytes to decrypt.
+    pos: The payload position (i - 0x10) of the first byte in view.
+    table: The table from CreateTableExf.
+  """
+
+  global _exfRamp
+  if _exfRamp is None:
+    _exfRamp = np.tile(np.arange(256, dtype=np.uint16) << 8, EXF_NUMPY_BLOCK // 256 + 1)
+  ramp = _exfRamp
+
+  for start in range(0, len(view), EXF_NUMPY_BLOCK):
+    block = view[start:start + EXF_NUMPY_BLOCK]
+    shift = (pos + start) & 0xFF
+    idx = ramp[shift:shift + len(block)] | block
+    np.take(table, idx, out=block)
+
+def decExfNumpy(buffer):
+  """Decrypts a file encrypted using the EXF algorithm with NumPy array operations.
+
+  The buffer is decrypted in place through a memoryview, so it may be a
+  bytearray, an mmap or any other writable buffer.
+
+  Args:
+    buffer: A writable buffer (bytearray, mmap, memoryview) containing the
+      encrypted file. It is decrypted in place.
+
+  Returns:
+    A memoryview of the decrypted payload.
+  """
+
+  header = bytes(buffer[:16])
+  if int.from_bytes(header[:4], "little") == 0x1a667865:
+    table = CreateTableExf(CreateXorkeyExf(header))
+    view = np.frombuffer(memoryview(buffer).cast("B"), dtype=np.uint8)
+    DecryptExfBlocks(view[16:max(16, len(view) - len(header))], 0, table)
+
+  return memoryview(buffer)[16:]
+
+# Chunk size handed to each worker thread by decExfChunked.
+EXF_CHUNK = 8 << 20
+
+def decExfChunked(buffer, workers=None, chunkSize=EXF_CHUNK):
+  """Decrypts a file encrypted using the EXF algorithm on a thread pool.
+
+  The payload is split into chunks that are decrypted independently and in
+  place, so buffer may be a bytearray, an mmap or any other writable buffer.
+  The NumPy kernels release the GIL, so the chunks run in parallel. Falls back
+  to decExfReference when NumPy is not installed.
+
+  Args:
+    buffer: A writable buffer (bytearray, mmap, memoryview) containing the
+      encrypted file. It is decrypted in place.
+    workers: The number of worker threads, or None for one per CPU.
+    chunkSize: The number of payload bytes per chunk.
+
+  Returns:
+    A memoryview of the decrypted payload.
+  """
+
+  if np is None:
+    return decExfReference(buffer)
+
+  header = bytes(buffer[:16])
+  if int.from_bytes(header[:4], "little") != 0x1a667865:
+    return memoryview(buffer)[16:]
+
+  table = CreateTableExf(CreateXorkeyExf(header))
+  view = np.frombuffer(memoryview(buffer).cast("B"), dtype=np.uint8)
+  payload = view[16:max(16, len(view) - len(header))]
+  if len(payload) <= chunkSize:
+    DecryptExfBlocks(payload, 0, table)
+    return memoryview(buffer)[16:]
+
+  with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+    jobs = [pool.submit(DecryptExfBlocks, payload[pos:pos + chunkSize], pos, table)
+            for pos in range(0, len(payload), chunkSize)]
+    for job in jobs:
+      job.result()
+
+  return memoryview(buffer)[16:]
+
+def decExfFile(path, workers=None):
+  """Decrypts an EXF file in place through a memory map.
+
+  Args:
+    path: The path to the encrypted file.
+    workers: The number of worker threads, or None for one per CPU.
+  """
+
+  with open(path, "r+b") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return
+    with mmap.mmap(f.fileno(), 0) as mm:
+      decExfChunked(mm, workers)
+      mm.flush()
+
+exfDecoders = {
+  "reference": decExfReference,
+}
+if np is not None:
+  exfDecoders["numpy"] = decExfNumpy
+  exfDecoders["chunked"] = decExfChunked
+
+def decExf(buffer):
+  """Decrypts a file encrypted using the EXF algorithm.
+
+  Uses the NumPy backend when NumPy is installed and the pure-Python one
+  otherwise.
+
+  Args:
+    buffer: A writable buffer (bytearray, mmap, memoryview) containing the
+      encrypted file. It is decrypted in place.
+
+  Returns:
+    A memoryview of the decrypted payload.
+  """
+
+  if np is not None:
+    return decExfNumpy(buffer)
+  return decExfReference(buffer)
+
+def decEcdFile(path, backend="table"):
+  """Decrypts an ECD file in place through a memory map.
+
+  The payload is decrypted inside the mapping and the 16-byte header is then
+  stripped with a single move and a truncate, so the file is never copied
+  into memory.
+
+  Args:
+    path: The path to the encrypted file.
+    backend: The name of the decryption backend in ecdDecoders.
+
+  Returns:
+    The 16-byte ECD header, or None if the file is not an ECD file or is
+    shorter than the payload size in its header (it is left unchanged).
+  """
+
+  with open(path, "r+b") as f:
+    size = os.fstat(f.fileno()).st_size
+    if size < 16:
+      return None
+
+    with mmap.mmap(f.fileno(), 0) as mm:
+      header = mm[:16]
+      if int.from_bytes(header[:4], "little") != 0x1A646365:
+        return None
+      if 16 + int.from_bytes(header[8:12], "little") > size:
+        return None
+
+      ecdDecoders[backend](mm)
+      mm.move(0, 16, size - 16)
+      mm.flush()
+
+    f.truncate(size - 16)
+
+  return header
+
+def verifyEcdFile(path, chunkSize=ECD_CHUNK):
+  """Checks the CRC32 of an ECD file without writing anything.
+
+  The file is decrypted in chunks through a memory map and the CRC32 of the
+  plaintext is compared against the one in the header.
+
+  Args:
+    path: The path to the encrypted file.
+    chunkSize: The number of bytes decrypted per step.
+
+  Returns:
+    A tuple (ok, expected, actual) with the header and computed CRC32, or
+    None if the file is not an ECD file. actual is None if the header claims
+    more data than the file holds.
+  """
+
+  size = os.path.getsize(path)
+  with open(path, "rb") as f:
+    header = f.read(16)
+    if len(header) < 16 or int.from_bytes(header[:4], "little") != 0x1A646365:
+      return None
+
+    decryptor = EcdDecryptor()
+    decryptor.feed(header)
+    if 16 + decryptor.fsize > size:
+      return (False, decryptor.expectedCrc32, None)
+
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+      for pos in range(16, 16 + decryptor.fsize, chunkSize):
+        decryptor.feed(mm[pos:min(pos + chunkSize, 16 + decryptor.fsize)])
+
+  return (decryptor.crc32 == decryptor.expectedCrc32, decryptor.expectedCrc32, decryptor.crc32)
+
+class EcdDecryptor:
+  """An incremental ECD decryptor, in the style of zlib.decompressobj.
+
+  The encrypted file, header included, is passed in pieces to feed(), which
+  returns the plaintext decrypted so far. The chained state (generator state
+  and r8) is carried across calls, so the file never has to be held in memory.
+  Bytes past the fsize given in the header are passed through unchanged.
+
+  Attributes:
+    header: The 16-byte ECD header, or None until it has been fed.
+    fsize: The payload size from the header.
+    expectedCrc32: The CRC32 from the header.
+    crc32: The CRC32 of the plaintext returned so far.
+    remaining: The number of payload bytes still to be decrypted.
+  """
+
+  def __init__(self):
+    self.header = None
+    self.fsize = 0
+    self.expectedCrc32 = 0
+    self.crc32 = 0
+    self.remaining = 0
+    self._pending = bytearray()
+    self._index = 0
+    self._rnd = 0
+    self._r8 = 0
+
+  def feed(self, data):
+    """Decrypts the next piece of the file.
+
+    Args:
+      data: The next bytes of the encrypted file.
+
+    Returns:
+      The plaintext bytes that are now available.
+    """
+
+    if self.header is None:
+      self._pending += data
+      if len(self._pending) < 16:
+        return b""
+      self.header = bytes(self._pending[:16])
+      data = bytes(self._pending[16:])
+      self._pending = bytearray()
+
+      self._index = int.from_bytes(self.header[4:6], "little")
+      self.fsize = int.from_bytes(self.header[8:12], "little")
+      self.expectedCrc32 = int.from_bytes(self.header[12:16], "little")
+      self.remaining = self.fsize
+      self._rnd = EcdSeed(self._index, self.expectedCrc32)
+      self._r8 = self._rnd & 0xFF
+
+    n = min(len(data), self.remaining)
+    if n == 0:
+      return bytes(data)
+
+    if np is not None:
+      self._rnd, keystream = EcdKeystreamNumpy(self._index, self._rnd, n)
+      out = np.empty(n, dtype=np.uint8)
+      self._r8 = DecryptEcdChunkNumpy(np.frombuffer(data, dtype=np.uint8, count=n), keystream, self._r8, out)
+      out = out.tobytes()
+    else:
+      self._rnd, keystream = EcdKeystream(self._index, self._rnd, n)
+      out, self._r8 = DecryptEcdChunk(data[:n], keystream, self._r8)
+      out = bytes(out)
+
+    self.remaining -= n
+    self.crc32 = binascii.crc32(out, self.crc32)
+    return out + bytes(data[n:]) if n < len(data) else out
+
+  def flush(self):
+    """Finishes decryption.
+
+    Returns:
+      The remaining plaintext bytes, which is always empty.
+
+    Raises:
+      ValueError: If the file ended before its header or payload did.
+    """
+
+    if self.header is None or self.remaining > 0:
+      raise ValueError("Truncated ECD file")
+    return b""
+
+class EcdEncryptor:
+  """An incremental ECD encryptor, in the style of zlib.compressobj.
+
+  The keystream is seeded from the CRC32 of the plaintext, so the size and
+  CRC32 have to be known up front; flush() checks them against the data that
+  was fed.
+
+  Attributes:
+    header: The 16-byte ECD header with fsize and crc32 filled in.
+    fsize: The plaintext size.
+    crc32: The CRC32 of the plaintext.
+  """
+
+  def __init__(self, bufferMeta, fsize, crc32, writeHeader=True):
+    """Creates an encryptor.
+
+    Args:
+      bufferMeta: A byte buffer containing the metadata for the encrypted file.
+      fsize: The plaintext size.
+      crc32: The CRC32 of the plaintext.
+      writeHeader: Whether the first call to feed() returns the header before
+        the ciphertext.
+    """
+
+    self.header = bytearray(bufferMeta[:16])
+    self.header[8:12] = fsize.to_bytes(4, "little")
+    self.header[12:16] = crc32.to_bytes(4, "little")
+    self.header = bytes(self.header)
+    self.fsize = fsize
+    self.crc32 = crc32
+    self._writeHeader = writeHeader
+    self._index = int.from_bytes(bufferMeta[4:6], "little")
+    self._rnd = EcdSeed(self._index, crc32)
+    self._r8 = self._rnd & 0xFF
+    self._fed = 0
+    self._fedCrc32 = 0
+
+  def feed(self, data):
+    """Encrypts the next piece of the plaintext.
+
+    Args:
+      data: The next plaintext bytes.
+
+    Returns:
+      The ciphertext bytes, preceded by the header on the first call if
+      writeHeader was set.
+    """
+
+    self._fed += len(data)
+    self._fedCrc32 = binascii.crc32(data, self._fedCrc32)
+
+    if np is not None:
+      self._rnd, keystream = EcdKeystreamNumpy(self._index, self._rnd, len(data))
+      out = np.empty(len(data), dtype=np.uint8)
+      self._r8 = EncryptEcdChunkNumpy(np.frombuffer(data, dtype=np.uint8), keystream, self._r8, out)
+      out = out.tobytes()
+    else:
+      self._rnd, keystream = EcdKeystream(self._index, self._rnd, len(data))
+      out, self._r8 = EncryptEcdChunk(data, keystream, self._r8)
+
+    if self._writeHeader:
+      self._writeHeader = False
+      return self.header + out
+    return out
+
+  def flush(self):
+    """Finishes encryption.
+
+    Returns:
+      The remaining ciphertext bytes: the header if nothing was fed yet and
+      writeHeader was set, otherwise empty.
+
+    Raises:
+      ValueError: If the data fed does not match the given size and CRC32.
+    """
+
+    if self._fed != self.fsize or self._fedCrc32 != self.crc32:
+      raise ValueError("ECD plaintext does not match the given size and CRC32")
+
+    if self._writeHeader:
+      self._writeHeader = False
+      return self.header
+    return b""
+
+class ExfDecryptor:
+  """An incremental EXF decryptor, in the style of zlib.decompressobj.
+
+  Like decExf, the header and the last 16 bytes of the file are passed
+  through unchanged, so the last 16 bytes fed are held back until flush().
+  Data without an EXF header is passed through unchanged.
+
+  Attributes:
+    header: The 16-byte EXF header, or None until it has been fed.
+  """
+
+  def __init__(self):
+    self.header = None
+    self._pending = bytearray()
+    self._pos = 0
+    self._key = None
+    self._table = None
+
+  def feed(self, data):
+    """Decrypts the next piece of the file.
+
+    Args:
+      data: The next bytes of the encrypted file.
+
+    Returns:
+      The plaintext bytes that are now available.
+    """
+
+    self._pending += data
+    out = b""
+
+    if self.header is None:
+      if len(self._pending) < 16:
+        return b""
+      self.header = bytes(self._pending[:16])
+      del self._pending[:16]
+      out = self.header
+      if int.from_bytes(self.header[:4], "little") == 0x1a667865:
+        self._key = CreateXorkeyExf(self.header)
+        if np is not None:
+          self._table = CreateTableExf(self._key)
+
+    n = len(self._pending) - 16
+    if n <= 0:
+      return out
+
+    chunk = self._pending[:n]
+    del self._pending[:n]
+    if self._key is not None:
+      if self._table is not None:
+        DecryptExfBlocks(np.frombuffer(chunk, dtype=np.uint8), self._pos, self._table)
+      else:
+        DecryptExfChunk(chunk, self._pos, self._key)
+    self._pos += n
+
+    return out + bytes(chunk)
+
+  def flush(self):
+    """Finishes decryption.
+
+    Returns:
+      The held-back bytes at the end of the file.
+    """
+
+    out = bytes(self._pending)
+    self._pending = bytearray()
+    return out
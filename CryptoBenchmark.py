@@ -0,0 +1,219 @@
+import sys
+import argparse
+import binascii
+import json
+import random
+import time
+import tracemalloc
+from Crypto import *
+
+# Sizes benchmarked by default, from 1 KB to 256 MB.
+DEFAULT_SIZES = [1 << 10, 64 << 10, 1 << 20, 16 << 20, 256 << 20]
+
+# The backends that process the payload one byte at a time in Python.
+SLOW_BACKENDS = {"reference", "table"}
+
+# The backends in SLOW_BACKENDS are only run up to this size.
+REFERENCE_LIMIT = 4 << 20
+
+# CRC32 of the 1 KB fixtures after encEcd (ECD) and decExf (EXF), per key index.
+KNOWN_ANSWERS_ECD = [0xc1108a2c, 0xf7327fad, 0xe6c30c82, 0x932d68f2, 0xc87da782, 0x9fc9e1b1]
+KNOWN_ANSWERS_EXF = [0x11aa3ac6, 0x1bf15b0a, 0x1ff3c9aa, 0xbfd0fc19, 0xa9156f20]
+
+def MakeEcdFixture(size, index=0, seed=0):
+  """Creates a deterministic plaintext and ECD .meta header.
+
+  Args:
+    size: The plaintext size in bytes.
+    index: The key index to store in the header.
+    seed: The seed for the plaintext.
+
+  Returns:
+    A tuple of the plaintext bytes and the 16-byte .meta header.
+  """
+
+  meta = bytearray(16)
+  meta[:4] = (0x1A646365).to_bytes(4, "little")
+  meta[4:6] = index.to_bytes(2, "little")
+  return random.Random(seed).randbytes(size), meta
+
+def MakeExfFixture(size, index=0, seed=0):
+  """Creates a deterministic EXF-encrypted buffer.
+
+  Args:
+    size: The payload size in bytes.
+    index: The key index to store in the header.
+    seed: The seed for the payload and header key.
+
+  Returns:
+    A bytearray holding the 16-byte header and the payload.
+  """
+
+  rng = random.Random(seed)
+  header = bytearray(16)
+  header[:4] = (0x1a667865).to_bytes(4, "little")
+  header[4:6] = index.to_bytes(2, "little")
+  header[12:16] = rng.getrandbits(32).to_bytes(4, "little")
+  return header + rng.randbytes(size)
+
+def Measure(func, *args):
+  """Runs a function twice, once for its run time and once for its peak memory.
+
+  Args:
+    func: The function to run.
+    args: The arguments to pass to it.
+
+  Returns:
+    A tuple of the elapsed seconds, the peak traced allocation in bytes and
+    the result of the timed run.
+  """
+
+  start_time = time.perf_counter()
+  result = func(*args)
+  elapsed = time.perf_counter() - start_time
+
+  tracemalloc.start()
+  func(*args)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+
+  return elapsed, peak, result
+
+def CheckKnownAnswers():
+  """Checks every backend against the known answers and round trips.
+
+  Returns:
+    A list of strings describing the failures, empty if all checks passed.
+  """
+
+  failures = []
+
+  for index in range(len(rndBufEcd) // 8):
+    plain, meta = MakeEcdFixture(1024, index, index)
+    for enc_name, enc in ecdEncoders.items():
+      encrypted = enc(plain, meta)
+      if binascii.crc32(encrypted) != KNOWN_ANSWERS_ECD[index]:
+        failures.append(f"encEcd {enc_name}: wrong ciphertext for key index {index}")
+      for dec_name, dec in ecdDecoders.items():
+        if bytes(dec(bytearray(encrypted))) != plain:
+          failures.append(f"encEcd {enc_name} -> decEcd {dec_name}: round trip failed for key index {index}")
+
+  for index in range(len(rndBufExf) // 8):
+    for name, dec in exfDecoders.items():
+      buffer = MakeExfFixture(1024, index, index)
+      dec(buffer)
+      if binascii.crc32(buffer) != KNOWN_ANSWERS_EXF[index]:
+        failures.append(f"decExf {name}: wrong plaintext for key index {index}")
+
+  return failures
+
+def RunBenchmarks(sizes, reference_limit=REFERENCE_LIMIT):
+  """Benchmarks every backend at every size and key index.
+
+  Backends are checked for byte-exact output against the reference backend
+  where it runs, and against the first other backend above reference_limit.
+
+  Args:
+    sizes: A list of payload sizes in bytes.
+    reference_limit: The largest size the backends in SLOW_BACKENDS are run at.
+
+  Returns:
+    A list of result records.
+  """
+
+  results = []
+
+  def Record(operation, backend, size, index, elapsed, peak, matches):
+    mb = size / (1024 * 1024)
+    results.append({
+      "operation": operation,
+      "backend": backend,
+      "size": size,
+      "key_index": index,
+      "seconds": elapsed,
+      "mb_per_s": mb / elapsed if elapsed > 0 else None,
+      "peak_bytes": peak,
+      "matches": matches,
+    })
+    print(f"{operation} {backend} [key {index}] {size} bytes: {elapsed:.3f} s, "
+          f"{results[-1]['mb_per_s'] or 0:.1f} MB/s, peak {peak / (1024 * 1024):.1f} MB"
+          f"{'' if matches else ' MISMATCH'}")
+
+  for size in sizes:
+    for index in range(len(rndBufEcd) // 8):
+      plain, meta = MakeEcdFixture(size, index, index)
+
+      expected = None
+      for name, enc in ecdEncoders.items():
+        if name in SLOW_BACKENDS and size > reference_limit:
+          continue
+        elapsed, peak, encrypted = Measure(enc, plain, meta)
+        expected = encrypted if expected is None else expected
+        Record("encEcd", name, size, index, elapsed, peak, encrypted == expected)
+
+      for name, dec in ecdDecoders.items():
+        if name in SLOW_BACKENDS and size > reference_limit:
+          continue
+        elapsed, peak, result = Measure(lambda: bytes(dec(bytearray(expected))))
+        Record("decEcd", name, size, index, elapsed, peak, result == plain)
+
+    for index in range(len(rndBufExf) // 8):
+      fixture = MakeExfFixture(size, index, index)
+
+      expected = None
+      for name, dec in exfDecoders.items():
+        if name in SLOW_BACKENDS and size > reference_limit:
+          continue
+        elapsed, peak, result = Measure(lambda: bytes(dec(bytearray(fixture))))
+        expected = result if expected is None else expected
+        Record("decExf", name, size, index, elapsed, peak, result == expected)
+
+  return results
+
+def ParseSize(text):
+  """Parses a size such as 1024, 64K, 16M or 1G.
+
+  Args:
+    text: The size string.
+
+  Returns:
+    The size in bytes.
+  """
+
+  units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+  text = text.strip().upper()
+  if text and text[-1] in units:
+    return int(text[:-1]) * units[text[-1]]
+  return int(text)
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-sizes", default=",".join(str(size) for size in DEFAULT_SIZES), help="Comma-separated payload sizes, e.g. 1K,1M,256M.")
+  parser.add_argument("-referenceLimit", default=str(REFERENCE_LIMIT), help="Largest size the per-byte backends (reference, table) are run at.")
+  parser.add_argument("-json", help="Write the results to this JSON file.")
+  parser.add_argument("-verifyOnly", action="store_true", help="Only run the known-answer and round-trip checks.")
+  args = parser.parse_args()
+
+  failures = CheckKnownAnswers()
+  for failure in failures:
+    print(f"FAILED: {failure}")
+  print(f"Known-answer checks: {'passed' if not failures else f'{len(failures)} failed'}")
+
+  results = []
+  if not args.verifyOnly:
+    sizes = [ParseSize(size) for size in args.sizes.split(",")]
+    results = RunBenchmarks(sizes, ParseSize(args.referenceLimit))
+
+  if args.json:
+    with open(args.json, "w") as f:
+      json.dump({"known_answer_failures": failures, "results": results}, f, indent=2)
+
+  # Fail the run if any check or any benchmarked output did not match.
+  mismatches = sum(1 for result in results if not result["matches"])
+  if mismatches:
+    print(f"Benchmark output mismatches: {mismatches}")
+  if failures or mismatches:
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -1,4 +1,122 @@
-import io
+import os
+import json
+import time
+import heapq
+import struct
+import collections
+from array import array
+
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+# Magic number and size of the JKR header.
+JPK_MAGIC = 0x1A524B4A
+JPK_HEADER_SIZE = 16
+
+# Farthest back an LZ match may reach.
+JPK_MAX_DIST = 0x1fff
+
+# Shortest and longest LZ match the format can encode; a length byte of 0xFF
+# escapes a raw run, so the longest match is 0x1A + 0xFE.
+JPK_MIN_MATCH = 3
+JPK_MAX_MATCH = 0x1a + 0xfe
+
+# Bytes of output DecodeToSink passes to its sink at a time.
+JPK_STREAM_CHUNK = 1 << 20
+
+# Room kept free in the DecodeToSink window for the longest token (a raw run).
+JPK_STREAM_MARGIN = JPK_MAX_DIST + 0x1B
+
+# Input DecodeLz keeps ahead of its read position when the LZ data is fed
+# in chunks: the longest raw run plus its flag and header bytes.
+JPK_STREAM_INPUT_MARGIN = JPK_STREAM_MARGIN + 8
+
+# Default number of hash chain links followed per position.
+JPK_DEFAULT_DEPTH = 64
+
+# Levels from which JPKEncodeLz finds matches with a BinaryTreeMatchFinder
+# (-compress [type],90 and up).
+JPK_BINARY_TREE_LEVEL = 9000
+
+# Levels from which JPKEncodeLz chooses its matches by optimal parsing
+# (-compress [type],100 and up).
+JPK_OPTIMAL_LEVEL = 10000
+
+# Size in bits of a literal: a flag bit and the byte.
+JPK_LITERAL_COST = 9
+
+# Named effort presets for JPKEncodeLz: the level plus the hash chain depth,
+# the match length at which a search stops early ("nice") and whether a
+# match is deferred when the next position has a longer one ("lazy").
+# "max" uses the binary tree finder and optimal parsing through its level.
+JPK_EFFORT_PRESETS = {
+  "fast": {"level": 1000, "depth": 8, "nice": 32, "lazy": False},
+  "normal": {"level": 1000, "depth": 64, "nice": JPK_MAX_MATCH, "lazy": True},
+  "max": {"level": JPK_OPTIMAL_LEVEL, "depth": None, "nice": JPK_MAX_MATCH, "lazy": False},
+}
+
+# Hash chain settings from least to most effort, which JPKDeadline moves
+# along between blocks, and the one it starts from.
+JPK_EFFORT_LADDER = [
+  {"depth": 4, "nice": 16, "lazy": False},
+  {"depth": 8, "nice": 32, "lazy": False},
+  {"depth": 32, "nice": 128, "lazy": True},
+  {"depth": 64, "nice": JPK_MAX_MATCH, "lazy": True},
+  {"depth": 256, "nice": JPK_MAX_MATCH, "lazy": True},
+]
+JPK_EFFORT_START = 3
+
+# Number of input bytes between effort changes under a deadline.
+JPK_DEADLINE_BLOCK = 1 << 16
+
+# Default minimum number of seconds between progress events of ShowProgress and JPKStats.
+JPK_PROGRESS_INTERVAL = 0.5
+
+# Longest Huffman code JPKEncodeHFI assigns.
+JPK_HUFFMAN_MAX_BITS = 16
+
+# Number of bytes WriteHuffman codes per NumPy block.
+JPK_HUFFMAN_NUMPY_BLOCK = 1 << 20
+
+def ParseJPKHeader(header):
+  """Parses a JKR header.
+
+  Args:
+    header: At least the first JPK_HEADER_SIZE bytes of the JPK data.
+
+  Returns:
+    A dict with the version, type, start_offset and out_size, or None if
+    the data is too short or does not start with the JKR magic.
+  """
+
+  if len(header) < JPK_HEADER_SIZE:
+    return None
+  magic, version, type, start_offset, out_size = struct.unpack_from("<IHHiI", header, 0)
+  if magic != JPK_MAGIC:
+    return None
+  return {"version": version, "type": type, "start_offset": start_offset, "out_size": out_size}
+
+def ReadJPKHeader(source, offset=0):
+  """Reads the JKR header of a file or of an entry inside one, without decoding anything.
+
+  Args:
+    source: A path, a binary file object, or a bytes-like object (such as an mmap).
+    offset: The offset of the JPK data in source, for archive entries.
+
+  Returns:
+    A dict as returned by ParseJPKHeader, or None if there is no JKR header at offset.
+  """
+
+  if isinstance(source, (str, os.PathLike)):
+    with open(source, "rb") as f:
+      f.seek(offset)
+      return ParseJPKHeader(f.read(JPK_HEADER_SIZE))
+  if hasattr(source, "read"):
+    source.seek(offset)
+    return ParseJPKHeader(source.read(JPK_HEADER_SIZE))
+  return ParseJPKHeader(source[offset:offset + JPK_HEADER_SIZE])
 
 class IJPKDecode:
   def ReadByte(self, s):
@@ -21,14 +139,235 @@ class IJPKDecode:
     """
     pass
 
+  def DecodeToSink(self, src, out_size, sink, pos=0):
+    """Decodes a buffer and passes the output to a sink in chunks.
+
+    Args:
+      src: A bytes-like object (such as an mmap) holding the compressed data.
+      out_size: The decoded size.
+      sink: A callable taking each chunk of output, such as a file's write method.
+      pos: The offset of the compressed data in src.
+
+    Returns:
+      The number of bytes passed to the sink.
+    """
+    pass
+
+  def DecodeInto(self, src, outBuffer, pos=0):
+    """Decodes a buffer into a writable buffer of the decoded size.
+
+    Args:
+      src: A bytes-like object (such as an mmap) holding the compressed data.
+      outBuffer: A writable buffer (such as an mmap of the output file) of the decoded size.
+      pos: The offset of the compressed data in src.
+
+    Returns:
+      The number of bytes decoded.
+    """
+    pass
+
 
 
 
 class ShowProgress:
+  """Prints the progress of an encoder, at most once per interval."""
+
+  def __init__(self, interval=JPK_PROGRESS_INTERVAL):
+    self.m_interval = interval
+    self.m_last = None
+
   def __call__(self, perc):
-    print(f"Progress: {perc}%")
+    now = time.perf_counter()
+    if perc >= 100 or self.m_last is None or now - self.m_last >= self.m_interval:
+      self.m_last = now
+      print(f"Progress: {perc}%")
+
+
+class JPKStats:
+  """Collects timing and match statistics from the JPK encoders and decoders.
+
+  A JPKStats can be passed wherever a showProgress callback is taken. Its
+  progress events are throttled to one per m_interval seconds (and the
+  last one) and passed to m_callback as dicts. Encoders whose m_stats is
+  set add the tokens of every parse through AddTokens, which counts them
+  from the LzTokens columns after the parse instead of in its loop.
+  Decoders have no hook of their own: they are run through DecodeToSink
+  with a sink from WrapSink, which counts the output chunks and reports
+  the progress (UnpackJPK does this when it is given a JPKStats). Totals
+  add up over every Begin/End pair, so one object can cover a batch of
+  files.
+
+  Attributes:
+    m_interval: The minimum number of seconds between progress events.
+    m_callback: A callable taking each progress event, or None.
+    m_operation: The operation of the current run ("encode" or "decode").
+    m_type: The JPK type of the current run.
+    m_total: The input size of the current run, or None if unknown.
+    m_done: The number of bytes WrapSink has passed on in the current run.
+    m_start: The time.perf_counter() value at the start of the current run.
+    m_last: The time of the last progress event, or None.
+    m_runs: Per operation, the number of runs, bytes in and out, and seconds.
+    m_literals: The number of literal tokens.
+    m_matches: The number of match tokens.
+    m_lengths: A Counter of match lengths.
+    m_offsets: A Counter of match distances by bit length.
+  """
+
+  def __init__(self, callback=None, interval=JPK_PROGRESS_INTERVAL):
+    self.m_interval = interval
+    self.m_callback = callback
+    self.m_operation = None
+    self.m_type = None
+    self.m_total = None
+    self.m_done = 0
+    self.m_start = time.perf_counter()
+    self.m_last = None
+    self.m_runs = {}
+    self.m_literals = 0
+    self.m_matches = 0
+    self.m_lengths = collections.Counter()
+    self.m_offsets = collections.Counter()
+
+  def Begin(self, operation, type=None, total=None):
+    """Starts timing a run.
+
+    Args:
+      operation: "encode" or "decode".
+      type: The JPK type.
+      total: The input size, used for the rate in progress events.
+    """
+
+    self.m_operation = operation
+    self.m_type = type
+    self.m_total = total
+    self.m_done = 0
+    self.m_last = None
+    self.m_start = time.perf_counter()
+
+  def End(self, inBytes, outBytes):
+    """Stops timing a run and adds it to the totals.
+
+    Args:
+      inBytes: The number of bytes read.
+      outBytes: The number of bytes written.
+
+    Returns:
+      The number of seconds the run took.
+    """
+
+    seconds = time.perf_counter() - self.m_start
+    run = self.m_runs.setdefault(self.m_operation, {"runs": 0, "bytes_in": 0, "bytes_out": 0, "seconds": 0.0})
+    run["runs"] += 1
+    run["bytes_in"] += inBytes
+    run["bytes_out"] += outBytes
+    run["seconds"] += seconds
+    return seconds
+
+  def __call__(self, perc):
+    self.Progress(perc)
+
+  def Progress(self, perc):
+    """Passes a progress event to the callback, unless one was passed less than m_interval ago.
+
+    Args:
+      perc: The percentage done.
+    """
+
+    if self.m_callback is None:
+      return
+    now = time.perf_counter()
+    if perc < 100 and self.m_last is not None and now - self.m_last < self.m_interval:
+      return
+    self.m_last = now
+
+    elapsed = now - self.m_start
+    done = self.m_total * perc // 100 if self.m_total else self.m_done
+    self.m_callback({
+      "operation": self.m_operation,
+      "type": self.m_type,
+      "percent": perc,
+      "elapsed": elapsed,
+      "bytes_per_second": done / elapsed if elapsed > 0 else 0.0,
+    })
+
+  def WrapSink(self, sink, outSize):
+    """Wraps a DecodeToSink sink to report the decoding progress.
+
+    Args:
+      sink: The sink to pass the chunks on to.
+      outSize: The decoded size.
+
+    Returns:
+      A sink that counts each chunk and reports progress before passing it on.
+    """
+
+    def Sink(chunk):
+      self.m_done += len(chunk)
+      self.Progress(100 * self.m_done // outSize if outSize else 100)
+      sink(chunk)
+
+    return Sink
+
+  def AddTokens(self, tokens):
+    """Adds the tokens of a parse to the match statistics.
+
+    Args:
+      tokens: An LzTokens.
+    """
+
+    literals = tokens.m_kind.count(JPK_TOKEN_LITERAL)
+    self.m_literals += literals
+    self.m_matches += len(tokens) - literals
+
+    # Literals have a length of 1 and a distance of 1, so they are taken
+    # back out of the counts rather than filtered in a loop.
+    self.m_lengths.update(tokens.m_len)
+    self.m_lengths[1] -= literals
+    self.m_offsets.update((ofs + 1).bit_length() for ofs in tokens.m_ofs)
+    self.m_offsets[1] -= literals
+
+  def Summary(self):
+    """Returns the statistics collected so far.
+
+    Returns:
+      A dict with the totals and throughput (bytes read per second) per
+      operation, the token counts, the literal share, and the match length
+      and distance histograms (distances bucketed by powers of two).
+    """
+
+    runs = {}
+    for operation, run in self.m_runs.items():
+      run = dict(run)
+      seconds = run["seconds"]
+      run["bytes_per_second"] = run["bytes_in"] / seconds if seconds > 0 else 0.0
+      runs[operation] = run
+
+    tokens = self.m_literals + self.m_matches
+    return {
+      "runs": runs,
+      "literals": self.m_literals,
+      "matches": self.m_matches,
+      "literal_ratio": self.m_literals / tokens if tokens else 0.0,
+      "match_lengths": {str(n): c for n, c in sorted(self.m_lengths.items()) if c > 0},
+      "match_distances": {f"{1 << (b - 1)}-{(1 << b) - 1}": c for b, c in sorted(self.m_offsets.items()) if c > 0},
+    }
+
+  def Json(self, indent=1):
+    """Returns Summary() as JSON.
+
+    Args:
+      indent: The indentation passed to json.dumps.
+
+    Returns:
+      A string.
+    """
+
+    return json.dumps(self.Summary(), indent=indent)
 
 class IJPKEncode:
+  # A JPKStats to add the tokens of every parse to, or None.
+  m_stats = None
+
   def WriteByte(self, s, b):
     """Writes a byte to the given stream.
 
@@ -57,357 +396,1291 @@ class JPKDecodeLz(IJPKDecode):
 
   This class implements the `IJPKDecode` interface and provides the `ProcessOnDecode()` method
   for decoding JPK files.
-
-  Attributes:
-    m_shiftIndex: The current shift index.
-    m_flag: The current flag byte.
   """
 
-  def __init__(self):
-    self.m_shiftIndex = 0
-    self.m_flag = 0
-
-  def jpkcpy_lz(self, outBuffer, offset, length, outIndex):
-    """Copies a length of bytes from the output buffer to the offset position.
+  def ProcessOnDecode(self, inStream, outBuffer):
+    """Decodes the input stream into the output buffer using the LZ algorithm.
 
     Args:
+      inStream: A stream representing the input stream.
       outBuffer: A bytearray representing the output buffer.
-      offset: The offset position to copy the bytes to.
-      length: The number of bytes to copy.
-      outIndex: A reference to the current index in the output buffer.
 
     Returns:
-      None.
+      The number of bytes written to the output buffer.
     """
 
-    for i in range(length):
-            outBuffer[outIndex] = outBuffer[outIndex - offset - 1]
-            outIndex += 1
+    return self.DecodeLz(inStream.read(), outBuffer)
+
+  def DecodeToSink(self, src, outSize, sink, pos=0):
+    """Decodes LZ data and passes the output to a sink in chunks.
 
-  def jpkbit_lz(self, s):
-    """Reads a bit from the input stream.
+    Only a window of JPK_STREAM_CHUNK bytes plus the 0x2000 bytes that
+    back-references can reach is kept in memory, whatever the output size.
 
     Args:
-      s: A stream representing the input stream.
+      src: A bytes-like object (such as an mmap) holding the LZ data.
+      outSize: The decoded size.
+      sink: A callable taking each chunk of output, such as a file's write method.
+      pos: The offset of the LZ data in src.
 
     Returns:
-      A byte representing the bit read.
+      The number of bytes passed to the sink.
     """
 
-    self.m_shiftIndex -= 1
-    if self.m_shiftIndex < 0:
-        self.m_shiftIndex = 7
-        self.m_flag = self.ReadByte(s)
+    return self.StreamLz(src, outSize, sink, pos)
 
-    return (self.m_flag >> self.m_shiftIndex) & 1
+  def StreamLz(self, src, outSize, sink, pos=0, refill=None):
+    """Decodes LZ data through a sliding output window and passes the output to a sink.
 
-  def ProcessOnDecode(self, inStream, outBuffer):
-    """Decodes the input stream into the output buffer using the LZ algorithm.
+    Args:
+      src: A bytes-like object holding the LZ data, or the first part of it with refill.
+      outSize: The decoded size.
+      sink: A callable taking each chunk of output.
+      pos: The offset of the LZ data in src.
+      refill: None, or a callable feeding the LZ data in parts (see DecodeLz).
+
+    Returns:
+      The number of bytes passed to the sink.
+    """
+
+    history = JPK_MAX_DIST + 1
+    window = bytearray(JPK_STREAM_CHUNK + history + JPK_STREAM_MARGIN)
+    emitted = 0
+
+    def Flush(o):
+      nonlocal emitted
+      n = o - history
+      sink(bytes(window[:n]))
+      window[:history] = window[n:o]
+      emitted += n
+      return history
+
+    total = self.DecodeLz(src, window, pos, outSize, Flush, refill)
+    sink(bytes(window[:total - emitted]))
+    return total
+
+  def DecodeInto(self, src, outBuffer, pos=0):
+    """Decodes LZ data into a writable buffer of the decoded size.
 
     Args:
-      inStream: A stream representing the input stream.
-      outBuffer: A bytearray representing the output buffer.
+      src: A bytes-like object (such as an mmap) holding the compressed data.
+      outBuffer: A writable buffer (such as an mmap of the output file) of the decoded size.
+      pos: The offset of the compressed data in src.
 
     Returns:
-      None.
+      The number of bytes decoded.
     """
 
-    outIndex = 0
-    while inStream.Position < inStream.Length and outIndex < len(outBuffer):
-        if self.jpkbit_lz(inStream) == 0:
-            outBuffer[outIndex] = self.ReadByte(inStream)
-            outIndex += 1
-            continue
+    return self.DecodeLz(src, outBuffer, pos)
+
+  def DecodeLz(self, src, outBuffer, pos=0, outSize=None, flush=None, refill=None):
+    """Decodes LZ data from a buffer into the output buffer.
+
+    The flag bits are kept in a local register and the input is indexed
+    directly, so runs of literals, raw runs and back-references are all
+    copied as slices. A back-reference that overlaps the bytes it produces
+    is built by repeating its pattern.
+
+    Args:
+      src: A bytes-like object holding the LZ data.
+      outBuffer: A writable buffer (bytearray, memoryview) to decode into.
+      pos: The offset of the LZ data in src.
+      outSize: The decoded size, or None for the size of the output buffer.
+      flush: None, or a callable used when outBuffer is a sliding window:
+        it is called with the fill level once fewer than JPK_STREAM_MARGIN
+        bytes are free, must keep at least the last 0x2000 bytes at the
+        start of the window, and returns the new fill level.
+      refill: None, or a callable used when src holds only part of the LZ
+        data: it is called with the read position before the first token
+        and whenever fewer than JPK_STREAM_INPUT_MARGIN bytes are left,
+        and returns a tuple of the new src (holding at least that margin
+        from the new read position, unless the data has run out), the new
+        read position, and whether the data has run out.
+
+    Returns:
+      The number of bytes decoded.
 
+    Raises:
+      ValueError: If a back-reference points before the start of the output.
+    """
+
+    out = outBuffer
+    if outSize is None:
+      outSize = len(out)
+    limit = len(out) - JPK_STREAM_MARGIN if flush else len(out)
+    base = 0
+    size = outSize
+    end = len(src)
+    o = 0
+    p = pos
+    flag = 0
+    rem = 0
+
+    final = refill is None
+    if not final:
+      src, p, final = refill(p)
+      end = len(src)
+    inLimit = end if final else end - JPK_STREAM_INPUT_MARGIN
+
+    while o < size and p < end:
+      if p > inLimit:
+        src, p, final = refill(p)
+        end = len(src)
+        inLimit = end if final else end - JPK_STREAM_INPUT_MARGIN
+
+      if o > limit:
+        kept = flush(o)
+        base += o - kept
+        size = outSize - base
+        o = kept
+
+      if rem == 0:
+        flag = src[p]
+        p += 1
+        rem = 8
+
+      # Copy the literals for every leading zero flag bit at once.
+      zeros = rem - (flag & ((1 << rem) - 1)).bit_length()
+      if zeros:
+        n = min(zeros, size - o, end - p)
+        out[o:o + n] = src[p:p + n]
+        o += n
+        p += n
+        rem -= zeros
+        continue
+
+      rem -= 1
+      if rem == 0:
+        flag = src[p]
+        p += 1
+        rem = 8
+      rem -= 1
+
+      if not (flag >> rem) & 1:
+        # Short match: two length bits and an offset byte.
+        if rem >= 2:
+          rem -= 2
+          length = (flag >> rem) & 3
         else:
-            if self.jpkbit_lz(inStream) == 0:
-                len = (self.jpkbit_lz(inStream) << 1) | self.jpkbit_lz(inStream)
-                off = self.ReadByte(inStream)
-                self.jpkcpy_lz(outBuffer, off, len + 3, outIndex)
-                continue
+          # The bits continue in the next flag byte.
+          length = flag & ((1 << rem) - 1)
+          need = 2 - rem
+          flag = src[p]
+          p += 1
+          rem = 8 - need
+          length = (length << need) | (flag >> rem)
+        length += 3
+        dist = src[p] + 1
+        p += 1
+
+      else:
+        hi = src[p]
+        lo = src[p + 1]
+        p += 2
+        length = hi >> 5
+        dist = (((hi & 0x1F) << 8) | lo) + 1
+
+        if length:
+          length += 2
 
+        else:
+          if rem == 0:
+            flag = src[p]
+            p += 1
+            rem = 8
+          rem -= 1
+
+          if not (flag >> rem) & 1:
+            # Four more length bits.
+            if rem >= 4:
+              rem -= 4
+              length = (flag >> rem) & 0xF
             else:
-                hi = self.ReadByte(inStream)
-                lo = self.ReadByte(inStream)
-                len = (hi & 0xE0) >> 5
-                off = ((hi & 0x1F) << 8) | lo
-
-                if len != 0:
-                    self.jpkcpy_lz(outBuffer, off, len + 2, outIndex)
-                    continue
-
-                else:
-                    if self.jpkbit_lz(inStream) == 0:
-                        len = (self.jpkbit_lz(inStream) << 3) | (self.jpkbit_lz(inStream) << 2) | (self.jpkbit_lz(inStream) << 1) | self.jpkbit_lz(inStream)
-                        self.jpkcpy_lz(outBuffer, off, len + 2 + 8, outIndex)
-                        continue
-
-                    else:
-                        temp = self.ReadByte(inStream)
-                        if temp == 0xFF:
-                            for i in range(off + 0x1B):
-                                outBuffer[outIndex] = self.ReadByte(inStream)
-                                outIndex += 1
-                            continue
-
-                        else:
-                            self.jpkcpy_lz(outBuffer, off, temp + 0x1A, outIndex)
-                            continue
-    
-  def ReadByte(self, s):
-    """Reads a byte from the input stream.
+              length = flag & ((1 << rem) - 1)
+              need = 4 - rem
+              flag = src[p]
+              p += 1
+              rem = 8 - need
+              length = (length << need) | (flag >> rem)
+            length += 10
+
+          else:
+            temp = src[p]
+            p += 1
+
+            if temp == 0xFF:
+              # Raw run of dist + 0x1A bytes.
+              n = min(dist + 0x1A, size - o, end - p)
+              out[o:o + n] = src[p:p + n]
+              o += n
+              p += n
+              continue
+
+            length = temp + 0x1A
+
+      start = o - dist
+      if start < 0:
+        raise ValueError(f"JPK back-reference at {o} reaches {dist} bytes back")
+
+      length = min(length, size - o)
+      if dist >= length:
+        out[o:o + length] = out[start:start + length]
+      else:
+        pattern = bytes(out[start:o])
+        out[o:o + length] = (pattern * (length // dist + 1))[:length]
+      o += length
+
+    return base + o
+
+
+
+def MatchLength(data, a, b, limit):
+  """Returns the length of the common prefix of data[a:] and data[b:].
+
+  Args:
+    data: A bytes object.
+    a: The first position.
+    b: The second position.
+    limit: The largest length to return.
+
+  Returns:
+    The match length, at most limit.
+  """
+
+  n = 0
+  while n + 16 <= limit and data[a + n:a + n + 16] == data[b + n:b + n + 16]:
+    n += 16
+    # Long matches usually run to the limit, so try the rest in one compare.
+    if n == 32 and data[a + n:a + limit] == data[b + n:b + limit]:
+      return limit
+  while n < limit and data[a + n] == data[b + n]:
+    n += 1
+  return n
+
+
+
+def MatchCost(length, ofs):
+  """Returns the size in bits of an LZ match token.
+
+  Args:
+    length: The match length, from JPK_MIN_MATCH to JPK_MAX_MATCH.
+    ofs: The match offset (the distance minus one).
+
+  Returns:
+    The number of flag and data bits the token takes.
+  """
+
+  if length <= 6 and ofs <= 0xff:
+    return 12
+  if length <= 9:
+    return 18
+  if length <= 25:
+    return 23
+  return 27
+
+
+
+class HashChainMatchFinder:
+  """A match finder for the JPK LZ encoder using hash chains.
+
+  Every position is linked into a chain of earlier positions with the same
+  3-byte hash. The chain heads live in an array indexed by hash and the links
+  in a ring buffer the size of the window, so a search only visits positions
+  that share a prefix with the current one.
+
+  Attributes:
+    m_data: The input buffer.
+    m_depth: The maximum number of chain links followed per search.
+    m_maxdist: The maximum match distance.
+    m_nice: The match length at which Find stops searching.
+    m_head: The most recent position for each hash, or -1.
+    m_prev: The previous position with the same hash, indexed by position & m_mask.
+    m_mask: The ring buffer mask for m_prev.
+    m_next: The next position to be inserted into the chains.
+  """
+
+  HASH_BITS = 15
+
+  def __init__(self, depth=JPK_DEFAULT_DEPTH, maxdist=JPK_MAX_DIST, nice=JPK_MAX_MATCH):
+    self.m_data = b""
+    self.m_depth = depth
+    self.m_maxdist = maxdist
+    self.m_nice = nice
+    self.m_head = array("i", [-1]) * (1 << self.HASH_BITS)
+    window = 1
+    while window <= maxdist:
+      window <<= 1
+    self.m_prev = array("i", [-1]) * window
+    self.m_mask = window - 1
+    self.m_next = 0
+
+  def Reset(self, data):
+    """Starts matching over a new input buffer.
+
+    Args:
+      data: A bytes object.
+    """
+
+    self.m_data = data
+    self.m_head = array("i", [-1]) * (1 << self.HASH_BITS)
+    self.m_next = 0
+
+  def Rebase(self, data, shift):
+    """Moves the finder onto a buffer that starts shift bytes later.
+
+    Used when a stream drops the start of its buffer. shift must be a
+    multiple of the ring size, so every position keeps its ring slot and
+    only the stored positions change.
 
     Args:
-      s: A stream representing the input stream.
+      data: The new buffer, whose position 0 is position shift of the old one.
+      shift: The number of bytes dropped.
+    """
+
+    self.m_data = data
+    self.m_head = array("i", (pos - shift if pos >= shift else -1 for pos in self.m_head))
+    self.m_prev = array("i", (pos - shift if pos >= shift else -1 for pos in self.m_prev))
+    self.m_next = max(self.m_next - shift, 0)
+
+  def Hash(self, pos):
+    """Hashes the three bytes at a position.
+
+    Args:
+      pos: The position.
 
     Returns:
-      A byte representing the byte read.
+      The hash, an index into m_head.
     """
 
-    value = s.ReadByte()
-    if value < 0:
-      raise Exception()
-    return 0xff & value
+    data = self.m_data
+    return ((data[pos] << 10) ^ (data[pos + 1] << 5) ^ data[pos + 2]) & ((1 << self.HASH_BITS) - 1)
 
+  def Insert(self, end):
+    """Links every position before end into the hash chains.
 
+    Args:
+      end: The first position not to insert.
+    """
 
-class JPKEncodeLz(IJPKEncode):
-  """A class for encoding JPK files using the LZ algorithm.
+    data = self.m_data
+    head = self.m_head
+    prev = self.m_prev
+    mask = self.m_mask
+    hmask = (1 << self.HASH_BITS) - 1
+    end = min(end, len(data) - 2)
 
-  This class implements the `IJPKEncode` interface and provides the `ProcessOnEncode()` method
-  for encoding JPK files.
+    for pos in range(self.m_next, end):
+      h = ((data[pos] << 10) ^ (data[pos + 1] << 5) ^ data[pos + 2]) & hmask
+      prev[pos & mask] = head[h]
+      head[h] = pos
+
+    self.m_next = max(self.m_next, end)
+
+  def Find(self, pos, nlen):
+    """Finds the longest match for a position.
+
+    Args:
+      pos: The position to match.
+      nlen: The maximum match length.
+
+    Returns:
+      A tuple (length, offset), where offset is the distance minus one, or
+      (0, 0) if there is no match of at least JPK_MIN_MATCH bytes.
+    """
+
+    if nlen < JPK_MIN_MATCH:
+      return 0, 0
+
+    self.Insert(pos)
+
+    data = self.m_data
+    prev = self.m_prev
+    mask = self.m_mask
+    stop = pos - self.m_maxdist
+    best = JPK_MIN_MATCH - 1
+    bestpos = -1
+
+    nice = min(nlen, self.m_nice)
+
+    cand = self.m_head[self.Hash(pos)]
+    depth = self.m_depth
+    while cand >= stop and cand >= 0 and depth > 0:
+      # Only candidates that beat the best match so far need a full compare.
+      if data[cand + best] == data[pos + best]:
+        n = MatchLength(data, cand, pos, nlen)
+        if n > best:
+          best = n
+          bestpos = cand
+          if n >= nice:
+            break
+      cand = prev[cand & mask]
+      depth -= 1
+
+    if bestpos < 0:
+      return 0, 0
+    return best, pos - bestpos - 1
+
+  def FindAll(self, pos, nlen):
+    """Finds the closest match of every length up to the longest one.
+
+    Args:
+      pos: The position to match.
+      nlen: The maximum match length.
+
+    Returns:
+      A list of (length, offset) tuples with increasing lengths, each the
+      closest match found that is longer than the previous one.
+    """
+
+    matches = []
+    if nlen < JPK_MIN_MATCH:
+      return matches
+
+    self.Insert(pos)
+
+    data = self.m_data
+    prev = self.m_prev
+    mask = self.m_mask
+    stop = pos - self.m_maxdist
+    best = JPK_MIN_MATCH - 1
+
+    cand = self.m_head[self.Hash(pos)]
+    depth = self.m_depth
+    while cand >= stop and cand >= 0 and depth > 0:
+      if data[cand + best] == data[pos + best]:
+        n = MatchLength(data, cand, pos, nlen)
+        if n > best:
+          best = n
+          matches.append((n, pos - cand - 1))
+          if n >= nlen:
+            break
+      cand = prev[cand & mask]
+      depth -= 1
+
+    return matches
+
+
+
+class BinaryTreeMatchFinder:
+  """A match finder for the JPK LZ encoder using binary search trees.
+
+  The positions in the window are kept in binary trees ordered by the bytes
+  that follow them, one tree per 3-byte hash. Inserting a position walks its
+  tree once, which both finds the longest match and re-roots the tree at the
+  new position, so a search takes O(log n) compares on typical data and
+  always returns the longest match within the window.
 
   Attributes:
-    m_flag: The current flag byte.
-    m_shiftIndex: The current shift index.
-    m_ind: The current index in the input buffer.
-    m_inp: The input buffer.
-    m_level: The compression level.
-    m_maxdist: The maximum distance.
-    m_outstream: The output stream.
-    m_towrite: A bytearray to store the bytes to be written to the output stream.
-    m_itowrite: The number of bytes in the `m_towrite` bytearray.
+    m_data: The input buffer.
+    m_depth: The maximum number of tree nodes visited per search.
+    m_maxdist: The maximum match distance.
+    m_maxlen: The longest match the trees are ordered by.
+    m_head: The tree root (most recent position) for each hash, or -1.
+    m_son: The left and right children of each position, at 2 * (position & m_mask).
+    m_mask: The ring buffer mask for m_son.
+    m_next: The next position to be inserted into the trees.
+  """
+
+  HASH_BITS = 16
+
+  def __init__(self, depth=None, maxdist=JPK_MAX_DIST, maxlen=JPK_MAX_MATCH):
+    self.m_data = b""
+    self.m_maxdist = maxdist
+    self.m_depth = maxdist if depth is None else depth
+    self.m_maxlen = maxlen
+    self.m_head = array("i", [-1]) * (1 << self.HASH_BITS)
+    window = 1
+    while window <= maxdist:
+      window <<= 1
+    self.m_son = array("i", [-1]) * (2 * window)
+    self.m_mask = window - 1
+    self.m_next = 0
+
+  def Reset(self, data):
+    """Starts matching over a new input buffer.
+
+    Args:
+      data: A bytes object.
+    """
+
+    self.m_data = data
+    self.m_head = array("i", [-1]) * (1 << self.HASH_BITS)
+    self.m_next = 0
+
+  def Rebase(self, data, shift):
+    """Moves the finder onto a buffer that starts shift bytes later.
+
+    Used when a stream drops the start of its buffer. shift must be a
+    multiple of the ring size, so every position keeps its ring slot and
+    only the stored positions change.
+
+    Args:
+      data: The new buffer, whose position 0 is position shift of the old one.
+      shift: The number of bytes dropped.
+    """
+
+    self.m_data = data
+    self.m_head = array("i", (pos - shift if pos >= shift else -1 for pos in self.m_head))
+    self.m_son = array("i", (pos - shift if pos >= shift else -1 for pos in self.m_son))
+    self.m_next = max(self.m_next - shift, 0)
+
+  def Insert(self, end):
+    """Inserts every position before end into the trees.
+
+    Args:
+      end: The first position not to insert.
+    """
+
+    for pos in range(self.m_next, end):
+      self.SearchInsert(pos)
+    self.m_next = max(self.m_next, end)
+
+  def SearchInsert(self, pos, matches=None):
+    """Inserts a position into its tree and finds its longest match.
+
+    Args:
+      pos: The position, which must be the next one to insert.
+      matches: A list to append (length, position) to for every match longer
+        than the ones before it, or None.
+
+    Returns:
+      A tuple of the match length and the matched position, or (0, -1).
+    """
+
+    data = self.m_data
+    limit = min(self.m_maxlen, len(data) - pos)
+    if limit < JPK_MIN_MATCH:
+      return 0, -1
+
+    h = ((data[pos] << 8) ^ (data[pos + 1] << 4) ^ data[pos + 2]) & ((1 << self.HASH_BITS) - 1)
+    cand = self.m_head[h]
+    self.m_head[h] = pos
+
+    son = self.m_son
+    mask = self.m_mask
+    stop = pos - self.m_maxdist
+    # Slots still waiting for the next node smaller (ptr1) or larger (ptr0)
+    # than pos, and how many bytes those nodes are known to share with it.
+    ptr1 = (pos & mask) << 1
+    ptr0 = ptr1 + 1
+    len1 = len0 = 0
+    best = 0
+    bestpos = -1
+    depth = self.m_depth
+
+    while True:
+      if cand < 0 or cand < stop or depth == 0:
+        son[ptr0] = son[ptr1] = -1
+        break
+      depth -= 1
+
+      n = min(len0, len1)
+      if data[cand + n] == data[pos + n]:
+        n += MatchLength(data, cand + n, pos + n, limit - n)
+      if n > best:
+        best = n
+        bestpos = cand
+        if matches is not None:
+          matches.append((n, cand))
+
+      pair = (cand & mask) << 1
+      if n == limit:
+        # cand is equal to pos as far as the trees look, so pos replaces it.
+        son[ptr1] = son[pair]
+        son[ptr0] = son[pair + 1]
+        break
+
+      if data[cand + n] < data[pos + n]:
+        son[ptr1] = cand
+        ptr1 = pair + 1
+        cand = son[ptr1]
+        len1 = n
+      else:
+        son[ptr0] = cand
+        ptr0 = pair
+        cand = son[ptr0]
+        len0 = n
+
+    return best, bestpos
+
+  def Find(self, pos, nlen):
+    """Finds the longest match for a position.
+
+    Args:
+      pos: The position to match.
+      nlen: The maximum match length.
+
+    Returns:
+      A tuple (length, offset), where offset is the distance minus one, or
+      (0, 0) if there is no match of at least JPK_MIN_MATCH bytes.
+    """
+
+    self.Insert(pos)
+    best, bestpos = self.SearchInsert(pos)
+    self.m_next = pos + 1
+
+    best = min(best, nlen)
+    if best < JPK_MIN_MATCH:
+      return 0, 0
+    return best, pos - bestpos - 1
+
+  def FindAll(self, pos, nlen):
+    """Finds the closest match of every length up to the longest one.
+
+    Args:
+      pos: The position to match.
+      nlen: The maximum match length.
+
+    Returns:
+      A list of (length, offset) tuples with increasing lengths, each the
+      closest match found that is longer than the previous one.
+    """
+
+    self.Insert(pos)
+    found = []
+    self.SearchInsert(pos, found)
+    self.m_next = pos + 1
+
+    matches = []
+    for n, cand in found:
+      n = min(n, nlen)
+      if n >= JPK_MIN_MATCH and (not matches or n > matches[-1][0]):
+        matches.append((n, pos - cand - 1))
+    return matches
+
+
+
+# Token kinds of an LzTokens stream.
+JPK_TOKEN_LITERAL = 0
+JPK_TOKEN_SHORT = 1
+JPK_TOKEN_LONG = 2
+JPK_TOKEN_LONG_4BIT = 3
+JPK_TOKEN_LONG_BYTE = 4
+
+class LzTokens:
+  """The tokens of an LZ parse, in parallel array columns.
+
+  Finding the tokens and writing them are separate passes: the encoders
+  fill an LzTokens, and Serialize() turns it into the flag bits and data
+  bytes of the JPK LZ format. One parse can therefore be written both as
+  type 3 and, through Huffman coding of the serialized bytes, as type 4.
+
+  Attributes:
+    m_kind: The token kind (JPK_TOKEN_*) of each token.
+    m_len: The match length of each token (1 for a literal).
+    m_ofs: The match offset (the distance minus one) of each token.
+    m_lit: The byte of each literal token (0 for a match).
+    m_flag: The flag byte being filled by Drain().
+    m_nbits: The number of bits used in m_flag.
+    m_pending: The data bytes Drain() has queued behind m_flag.
   """
 
   def __init__(self):
+    self.m_kind = array("I")
+    self.m_len = array("I")
+    self.m_ofs = array("I")
+    self.m_lit = array("I")
     self.m_flag = 0
-    self.m_shiftIndex = 8
-    self.m_ind = 0
-    self.m_inp = None
-    self.m_level = 1000
-    self.m_maxdist = 0x1fff
-    self.m_outstream = None
-    self.m_towrite = bytearray(1000)
-    self.m_itowrite = 0
+    self.m_nbits = 0
+    self.m_pending = bytearray()
 
-  def FindRep(self, ind, ofs):
-    """Finds a repeating pattern in the input buffer.
+  def __len__(self):
+    return len(self.m_kind)
+
+  def AppendLiteral(self, b):
+    """Appends a literal token.
 
     Args:
-      ind: The current index in the input buffer.
-      ofs: A reference to the output offset.
+      b: The literal byte.
+    """
+
+    self.m_kind.append(JPK_TOKEN_LITERAL)
+    self.m_len.append(1)
+    self.m_ofs.append(0)
+    self.m_lit.append(b)
+
+  def AppendMatch(self, length, ofs):
+    """Appends a match token, in the shortest form that can hold it.
+
+    Args:
+      length: The match length, from JPK_MIN_MATCH to JPK_MAX_MATCH.
+      ofs: The match offset (the distance minus one).
+    """
+
+    if length <= 6 and ofs <= 0xff:
+      kind = JPK_TOKEN_SHORT
+    elif length <= 9:
+      kind = JPK_TOKEN_LONG
+    elif length <= 25:
+      kind = JPK_TOKEN_LONG_4BIT
+    else:
+      kind = JPK_TOKEN_LONG_BYTE
+
+    self.m_kind.append(kind)
+    self.m_len.append(length)
+    self.m_ofs.append(ofs)
+    self.m_lit.append(0)
+
+  def Serialize(self):
+    """Writes the tokens in the JPK LZ format.
 
     Returns:
-      The length of the repeating pattern, or 0 if no repeating pattern is found.
+      A bytearray with the encoded data.
     """
 
-    nlen = min(self.m_level, len(self.m_inp) - ind)
-    ofs.value = 0
+    return self.SerializeFrom(0, 0, bytearray(), True)[0]
 
-    if ind == 0 or nlen < 3:
-      return 0
+  def Drain(self, final=False):
+    """Writes the tokens so far and removes them.
 
-    ista = ind if ind < self.m_maxdist else ind - self.m_maxdist
+    The flag byte that is still being filled and the data bytes behind it
+    are kept for the next call, so a stream can be written in pieces.
 
-    with io.BytesIO(self.m_inp) as inp:
-      psta = inp.read(ista)
-      pcur = inp.read(ind)
-      len = 0
+    Args:
+      final: Whether this is the last call, which writes out the last flag byte.
 
-      while psta < pcur:
-        lenw = 0
-        pfin = psta + nlen
+    Returns:
+      A bytearray with the encoded data.
+    """
 
-        for i in range(len(psta)):
-          pb = psta[i]
-          pb2 = pcur[i]
-          if pb != pb2:
-            break
-          lenw += 1
+    out, self.m_flag, self.m_nbits = self.SerializeFrom(self.m_flag, self.m_nbits, self.m_pending, final)
+    del self.m_kind[:]
+    del self.m_len[:]
+    del self.m_ofs[:]
+    del self.m_lit[:]
+    return out
 
-        if lenw > len and lenw >= 3:
-          len = lenw
-          ofs.value = pcur - psta - 1
+  def SerializeFrom(self, flag, nbits, pending, final):
+    """Writes the tokens in the JPK LZ format, continuing a flag byte.
 
-          if len >= nlen:
-            break
+    Flag bits are collected most significant bit first. A flag byte is
+    written when a ninth bit is needed, followed by the data bytes queued
+    since the previous flag byte. The last flag byte is written whenever
+    any of its bits were used.
 
-        psta = inp.read(1)
+    Args:
+      flag: The flag byte being filled.
+      nbits: The number of bits used in flag.
+      pending: A bytearray with the data bytes queued behind flag; it is
+        updated in place.
+      final: Whether to write out the last flag byte and its data bytes.
+
+    Returns:
+      A tuple of a bytearray with the encoded data, and the flag byte and
+      number of bits used in it to continue from.
+    """
+
+    out = bytearray()
+
+    def Bits(value, count):
+      nonlocal flag, nbits
+      while count:
+        if nbits == 8:
+          out.append(flag)
+          out.extend(pending)
+          pending.clear()
+          flag = 0
+          nbits = 0
+        take = min(count, 8 - nbits)
+        count -= take
+        flag |= ((value >> count) & ((1 << take) - 1)) << (8 - nbits - take)
+        nbits += take
+
+    for kind, length, ofs, lit in zip(self.m_kind, self.m_len, self.m_ofs, self.m_lit):
+      if kind == JPK_TOKEN_LITERAL:
+        Bits(0, 1)
+        pending.append(lit)
+
+      elif kind == JPK_TOKEN_SHORT:
+        Bits(0b1000 | (length - 3), 4)
+        pending.append(ofs)
+
+      else:
+        Bits(0b11, 2)
+        if kind == JPK_TOKEN_LONG:
+          ofs |= (length - 2) << 13
+        pending.append(ofs >> 8)
+        pending.append(ofs & 0xff)
+
+        if kind == JPK_TOKEN_LONG_4BIT:
+          Bits(length - 10, 5)
+        elif kind == JPK_TOKEN_LONG_BYTE:
+          Bits(1, 1)
+          pending.append(length - 0x1a)
+
+    if final and (nbits or pending):
+      out.append(flag)
+      out.extend(pending)
+      pending.clear()
+      flag = 0
+      nbits = 0
+
+    return out, flag, nbits
+
+
+
+class JPKDeadline:
+  """Adapts the LZ effort so a batch of encodes finishes within a time budget.
+
+  Encoders sharing a deadline ask it for a rung of JPK_EFFORT_LADDER before
+  every block and report the block's throughput after it. The deadline
+  compares the measured throughput with the rate still needed to encode
+  the remaining bytes in the remaining time, and steps down the ladder
+  when it falls behind, or up when it has time to spare.
+
+  Attributes:
+    m_end: The time.perf_counter() value by which the batch should finish.
+    m_remaining: The number of input bytes still to encode. Only the LZ
+      encoders (types 3 and 4) report to a deadline, so the total it is
+      created with should only count their inputs.
+    m_rates: The measured throughput in bytes per second of each rung, or None.
+    m_effort: The current rung.
+  """
 
-    return len
+  def __init__(self, seconds, totalBytes):
+    self.m_end = time.perf_counter() + seconds
+    self.m_remaining = totalBytes
+    self.m_rates = [None] * len(JPK_EFFORT_LADDER)
+    self.m_effort = JPK_EFFORT_START
 
-  def flushflag(self, final):
-    """Flushes the current flag to the output stream.
+  def Effort(self):
+    """Picks the rung for the next block.
+
+    Returns:
+      An index into JPK_EFFORT_LADDER.
+    """
+
+    left = self.m_end - time.perf_counter()
+    need = self.m_remaining / left if left > 0 else float("inf")
+    rates = self.m_rates
+    i = self.m_effort
+
+    if rates[i] is not None:
+      if rates[i] < need:
+        while i > 0 and rates[i] is not None and rates[i] < need:
+          i -= 1
+      elif i + 1 < len(rates):
+        # Try the next rung if it is known to be fast enough, or if this
+        # one is twice as fast as needed.
+        up = rates[i + 1]
+        if (up is None and rates[i] >= 2 * need) or (up is not None and up >= need):
+          i += 1
+
+    self.m_effort = i
+    return i
+
+  def Record(self, effort, nbytes, seconds):
+    """Records the throughput of a block.
 
     Args:
-      final: Whether this is the final flush.
+      effort: The rung the block was encoded at.
+      nbytes: The number of input bytes in the block.
+      seconds: The time the block took.
     """
 
-    if not final or self.m_itowrite > 0:
-      self.WriteByte(self.m_outstream, self.m_flag)
+    rate = nbytes / max(seconds, 1e-6)
+    old = self.m_rates[effort]
+    self.m_rates[effort] = rate if old is None else 0.7 * old + 0.3 * rate
+    self.m_remaining -= nbytes
 
-    self.m_flag = 0
 
-    for i in range(self.m_itowrite):
-      self.WriteByte(self.m_outstream, self.m_towrite[i])
 
-    self.m_itowrite = 0
+class JPKEncodeLz(IJPKEncode):
+  """A class for encoding JPK files using the LZ algorithm.
 
-  def SetFlag(self, b):
-    """Sets a bit in the current flag.
+  This class implements the `IJPKEncode` interface and provides the `ProcessOnEncode()` method
+  for encoding JPK files. The input is first parsed into an LzTokens stream
+  by `Tokenize()`, which `EncodeTokens()` then writes.
+
+  Attributes:
+    m_ind: The current index in the input buffer.
+    m_inp: The input buffer.
+    m_level: The compression level, used as the maximum match length.
+    m_maxdist: The maximum distance.
+    m_depth: The number of match finder steps per position, or None for the finder's default.
+    m_finderType: The match finder class, or None to pick one from the level.
+    m_finder: The match finder.
+    m_optimal: Whether to choose matches by optimal parsing, or None to decide from the level.
+    m_nice: The match length at which the hash chain search stops.
+    m_lazy: Whether a match is deferred when the next position has a longer one.
+    m_deadline: A JPKDeadline that adapts the effort between blocks, or None.
+    m_tokens: The tokens of the current parse.
+  """
+
+  def __init__(self, depth=None, finder=None, optimal=None, nice=JPK_MAX_MATCH, lazy=False, deadline=None):
+    self.m_ind = 0
+    self.m_inp = None
+    self.m_level = 1000
+    self.m_maxdist = JPK_MAX_DIST
+    self.m_depth = depth
+    self.m_finderType = finder
+    self.m_finder = None
+    self.m_optimal = optimal
+    self.m_nice = nice
+    self.m_lazy = lazy
+    self.m_deadline = deadline
+    self.m_tokens = None
+
+  def FindRep(self, ind):
+    """Finds a repeating pattern in the input buffer.
 
     Args:
-      b: The bit to set.
+      ind: The current index in the input buffer.
+
+    Returns:
+      A tuple of the length of the repeating pattern (0 if none is found) and
+      its offset (the distance minus one).
     """
 
-    self.m_shiftIndex -= 1
+    nlen = min(self.m_level, JPK_MAX_MATCH, len(self.m_inp) - ind)
+    if ind == 0:
+      return 0, 0
+
+    return self.m_finder.Find(ind, nlen)
 
-    if self.m_shiftIndex < 0:
-      self.m_shiftIndex = 7
-      self.flushflag(False)
+  def EmitLiteral(self, b):
+    """Adds a literal token.
 
-    self.m_flag |= b << self.m_shiftIndex
+    Args:
+      b: The literal byte.
+    """
 
-  def SetFlagsL(self, b, cnt):
-    """Sets multiple bits in the current flag.
+    self.m_tokens.AppendLiteral(b)
+
+  def EmitMatch(self, length, ofs):
+    """Adds a match token.
 
     Args:
-      b: The byte containing the bits to set.
-      cnt: The number of bits to set.
+      length: The match length, from JPK_MIN_MATCH to JPK_MAX_MATCH.
+      ofs: The match offset (the distance minus one).
     """
 
-    for i in range(cnt - 1, -1, -1):
-      self.SetFlag((b >> i) & 1)
-    
-  def ProcessOnEncode(self, inBuffer, outStream, level=1000, showProgress=None):
-    """Encodes the input buffer to the output stream using the LZ algorithm.
+    self.m_tokens.AppendMatch(length, ofs)
+
+  def ParseOptimal(self, showProgress=None):
+    """Chooses the tokens for the whole input by dynamic programming.
+
+    Every position is matched with FindAll, and the cheapest way in bits
+    to reach every position is kept (see JPK_LITERAL_COST and MatchCost).
+    For each match only the lengths where its token cost changes are tried,
+    so the parse is near-optimal rather than exhaustive.
+
+    Args:
+      showProgress: A callback function to show the progress of the encoding.
+
+    Returns:
+      A list of (length, offset) tuples, with a length of 0 for a literal.
+    """
+
+    data = self.m_inp
+    size = len(data)
+    finder = self.m_finder
+    maxlen = min(self.m_level, JPK_MAX_MATCH)
+
+    cost = [0] * (size + 1)
+    for i in range(1, size + 1):
+      cost[i] = i * JPK_LITERAL_COST
+    fromLen = array("H", [1]) * (size + 1)
+    fromOfs = array("i", [-1]) * (size + 1)
+    perc0 = 0
+
+    for i in range(1, size):
+      if showProgress and i & 0xfff == 0:
+        perc = 100 * i // size
+        if perc > perc0:
+          perc0 = perc
+          showProgress(perc)
+
+      c = cost[i]
+      if c + JPK_LITERAL_COST < cost[i + 1]:
+        cost[i + 1] = c + JPK_LITERAL_COST
+        fromLen[i + 1] = 1
+        fromOfs[i + 1] = -1
+
+      shorter = JPK_MIN_MATCH - 1
+      for length, ofs in finder.FindAll(i, min(maxlen, size - i)):
+        # Lengths up to `shorter` are cheaper from a closer match.
+        for n in (6, 9, 25, length):
+          if shorter < n <= length:
+            cc = c + MatchCost(n, ofs)
+            if cc < cost[i + n]:
+              cost[i + n] = cc
+              fromLen[i + n] = n
+              fromOfs[i + n] = ofs
+        shorter = length
+
+    tokens = []
+    i = size
+    while i > 0:
+      n = fromLen[i]
+      tokens.append((n, fromOfs[i]) if fromOfs[i] >= 0 else (0, 0))
+      i -= n
+    tokens.reverse()
+    return tokens
+
+  def Tokenize(self, inBuffer, level=1000, showProgress=None):
+    """Parses the input buffer into LZ tokens.
 
     Args:
         inBuffer: A bytearray containing the input data.
-        outStream: A stream to write the encoded data to.
         level: The compression level.
         showProgress: A callback function to show the progress of the encoding.
 
     Returns:
-        None.
+        An LzTokens object.
     """
 
-    self.m_inp = inBuffer
-    self.m_outstream = outStream
+    self.m_inp = bytes(inBuffer)
+    self.m_ind = 0
+    self.m_tokens = LzTokens()
     self.m_level = level
+    self.m_finder = self.CreateFinder(level)
+    self.m_finder.Reset(self.m_inp)
+
+    optimal = self.m_optimal
+    if optimal is None:
+      optimal = level >= JPK_OPTIMAL_LEVEL and self.m_deadline is None
 
-    perc = 0
+    size = len(self.m_inp)
     perc0 = 0
-    percbord = 0
 
     if showProgress:
-        showProgress(perc)
+        showProgress(0)
 
-    while self.m_ind < len(inBuffer):
-        perc = percbord + (100 - percbord) * self.m_ind / len(inBuffer)
+    if optimal:
+        for length, ofs in self.ParseOptimal(showProgress):
+            if length == 0:
+                self.EmitLiteral(self.m_inp[self.m_ind])
+                self.m_ind += 1
+            else:
+                self.EmitMatch(length, ofs)
+                self.m_ind += length
+
+    while self.m_ind < size:
+        self.ParseBlock(min(self.m_ind + JPK_STREAM_CHUNK, size))
 
+        perc = 100 * self.m_ind // size
         if perc > perc0:
             perc0 = perc
             if showProgress:
                 showProgress(perc)
 
-        ofs = io.BytesIO()
-        len = self.FindRep(self.m_ind, ofs)
+    if self.m_stats is not None:
+        self.m_stats.AddTokens(self.m_tokens)
+
+    if showProgress:
+        showProgress(100)
+
+    return self.m_tokens
+
+  def ParseBlock(self, stop):
+    """Parses the input greedily from m_ind up to stop.
+
+    With a deadline, the effort is picked before every JPK_DEADLINE_BLOCK
+    bytes and their throughput recorded after them.
+
+    Args:
+      stop: The position to stop at (a match may run past it).
+    """
 
-        if len == 0:
-            self.SetFlag(0)
-            self.m_towrite[self.m_itowrite] = inBuffer[self.m_ind]
-            self.m_itowrite += 1
+    deadline = self.m_deadline
+    if deadline is not None:
+      while self.m_ind < stop:
+        effort = deadline.Effort()
+        self.ApplyEffort(JPK_EFFORT_LADDER[effort])
+        start = self.m_ind
+        startTime = time.perf_counter()
+        self.ParseRange(min(start + JPK_DEADLINE_BLOCK, stop))
+        deadline.Record(effort, self.m_ind - start, time.perf_counter() - startTime)
+    else:
+      self.ParseRange(stop)
+
+  def ParseRange(self, stop):
+    """Parses the input greedily from m_ind up to stop with the current settings.
+
+    With lazy matching, a match is only taken if the next position does
+    not have a longer one; otherwise a literal is written and the longer
+    match taken from the next position.
+
+    Args:
+      stop: The position to stop at (a match may run past it).
+    """
+
+    inp = self.m_inp
+    lazy = self.m_lazy
+    ahead = None
+
+    while self.m_ind < stop:
+        if ahead is None:
+            length, ofs = self.FindRep(self.m_ind)
+        else:
+            length, ofs = ahead
+            ahead = None
+
+        if length and lazy and length < self.m_nice and self.m_ind + 1 < stop:
+            ahead = self.FindRep(self.m_ind + 1)
+            if ahead[0] > length:
+                length = 0
+            else:
+                ahead = None
+
+        if length == 0:
+            self.EmitLiteral(inp[self.m_ind])
             self.m_ind += 1
 
         else:
-            self.SetFlag(1)
+            self.EmitMatch(length, ofs)
+            self.m_ind += length
 
-            if len <= 6 and ofs.value <= 0xff:
-                self.SetFlag(0)
-                self.SetFlagsL((len - 3), 2)
-                self.m_towrite[self.m_itowrite] = ofs.value
-                self.m_itowrite += 1
-                self.m_ind += len
+  def ApplyEffort(self, settings):
+    """Switches the hash chain settings, also in the middle of a parse.
 
-            else:
-                self.SetFlag(1)
-                u16 = ofs.value
-                hi = (u16 >> 8) & 0xff
-                lo = u16 & 0xff
+    Args:
+      settings: A dict with the depth, nice and lazy settings (see JPK_EFFORT_LADDER).
+    """
+
+    self.m_depth = settings["depth"]
+    self.m_nice = settings["nice"]
+    self.m_lazy = settings["lazy"]
+    if isinstance(self.m_finder, HashChainMatchFinder):
+      self.m_finder.m_depth = self.m_depth
+      self.m_finder.m_nice = self.m_nice
+
+  def CreateFinder(self, level):
+    """Creates the match finder for a compression level.
+
+    Args:
+        level: The compression level.
+
+    Returns:
+        A HashChainMatchFinder or BinaryTreeMatchFinder, unless m_finderType says otherwise.
+    """
+
+    finderType = self.m_finderType
+    if finderType is None:
+      # Only the hash chains can change their effort between blocks.
+      if level >= JPK_BINARY_TREE_LEVEL and self.m_deadline is None:
+        finderType = BinaryTreeMatchFinder
+      else:
+        finderType = HashChainMatchFinder
+    if self.m_depth is None:
+      return finderType(maxdist=self.m_maxdist)
+    if finderType is HashChainMatchFinder:
+      return finderType(self.m_depth, self.m_maxdist, self.m_nice)
+    return finderType(self.m_depth, self.m_maxdist)
+
+  def EncodeStream(self, chunks, outStream, level=1000, showProgress=None, size=None):
+    """Encodes a stream of input chunks with the LZ algorithm in constant memory.
+
+    Only the last 0x2000 bytes of input (rounded up to the match finder's
+    ring) plus the chunk being parsed are kept, and the encoded data is
+    written as the parse goes. Matches are found greedily, since optimal
+    parsing needs the whole input.
+
+    Args:
+        chunks: An iterable of bytes-like chunks, or a file object to read.
+        outStream: A stream to write the encoded data to.
+        level: The compression level.
+        showProgress: A callback function to show the progress of the encoding.
+        size: The total input size for progress reports, or None if unknown.
+
+    Returns:
+        The number of input bytes encoded, for the header's out_size field.
+    """
+
+    if hasattr(chunks, "read"):
+      stream = chunks
+      chunks = iter(lambda: stream.read(JPK_STREAM_CHUNK), b"")
 
-                if len <= 9:
-                    u16 |= (len - 2) << 13
+    self.m_level = level
+    self.m_tokens = LzTokens()
+    self.m_finder = self.CreateFinder(level)
+    ring = self.m_finder.m_mask + 1
+
+    buf = b""
+    base = 0
+    self.m_ind = 0
+    perc0 = 0
+    self.m_finder.Reset(buf)
 
-                self.m_towrite[self.m_itowrite] = hi
-                self.m_itowrite += 1
-                self.m_towrite[self.m_itowrite] = lo
-                self.m_itowrite += 1
-                self.m_ind += len
+    if showProgress:
+        showProgress(0)
+
+    chunks = iter(chunks)
+    final = False
+    while not final:
+        chunk = next(chunks, None)
+        final = chunk is None
+        if not final:
+            if not chunk:
+                continue
+            buf += chunk
+
+        # Drop the input no match can reach any more, in whole rings.
+        shift = (self.m_ind - ring) // ring * ring
+        if shift > 0:
+            buf = buf[shift:]
+            self.m_ind -= shift
+            base += shift
+            self.m_finder.Rebase(buf, shift)
+        else:
+            self.m_finder.m_data = buf
 
-                if len > 9:
-                    if len <= 25:
-                        self.SetFlag(0)
-                        self.SetFlagsL((len - 10), 4)
+        self.m_inp = buf
+        # Without the last chunk, stop where a match could still grow.
+        stop = len(buf) if final else len(buf) - JPK_MAX_MATCH
 
-                    else:
-                        self.SetFlag(1)
-                        self.m_towrite[self.m_itowrite] = len - 0x1a
-                        self.m_itowrite += 1
+        self.ParseBlock(stop)
 
-    self.flushflag(True)
+        if self.m_stats is not None:
+            self.m_stats.AddTokens(self.m_tokens)
+        outStream.write(self.m_tokens.Drain(final))
+
+        if showProgress and size:
+            perc = min(100 * (base + self.m_ind) // size, 100)
+            if perc > perc0:
+                perc0 = perc
+                showProgress(perc)
 
     if showProgress:
         showProgress(100)
 
-  def WriteByte(self, s, b):
-    """Writes a byte to the stream.
+    return base + self.m_ind
+
+  def EncodeTokens(self, tokens, outStream):
+    """Writes LZ tokens to the output stream.
+
+    Args:
+        tokens: An LzTokens object.
+        outStream: A stream to write the encoded data to.
+    """
+
+    outStream.write(tokens.Serialize())
+
+  def ProcessOnEncode(self, inBuffer, outStream, level=1000, showProgress=None):
+    """Encodes the input buffer to the output stream using the LZ algorithm.
 
     Args:
-        s: The stream to write to.
-        b: The byte to write.
+        inBuffer: A bytearray containing the input data.
+        outStream: A stream to write the encoded data to.
+        level: The compression level.
+        showProgress: A callback function to show the progress of the encoding.
 
     Returns:
         None.
     """
 
-    s.write(bytes([b]))
+    self.EncodeTokens(self.Tokenize(inBuffer, level, showProgress), outStream)
 
 
 
 class JPKDecodeHFI(JPKDecodeLz):
   """A class for decoding JPK files using the LZ algorithm with Huffman coding.
 
-  This class inherits from the `JPKDecodeLz` class and overrides the `ProcessOnDecode()` and `ReadByte()` methods
-  to support Huffman coding.
-
-  Attributes:
-    m_flagHF: The current flag byte for Huffman coding.
-    m_flagShift: The current flag shift for Huffman coding.
-    m_hfTableOffset: The offset of the Huffman table in the stream.
-    m_hfDataOffset: The offset of the Huffman data in the stream.
-    m_hfTableLen: The length of the Huffman table.
+  This class inherits from the `JPKDecodeLz` class. The Huffman-coded byte
+  stream is decoded in full first and then passed through `DecodeLz()`.
   """
 
-  def __init__(self):
-    super().__init__()
-
-    self.m_flagHF = 0
-    self.m_flagShift = 0
-    self.m_hfTableOffset = 0
-    self.m_hfDataOffset = 0
-    self.m_hfTableLen = 0
-
   def ProcessOnDecode(self, inStream, outBuffer):
     """Decodes the input stream to the output buffer using the LZ algorithm with Huffman coding.
 
@@ -416,190 +1689,496 @@ class JPKDecodeHFI(JPKDecodeLz):
       outBuffer: A bytearray to write the decoded data to.
 
     Returns:
-      None.
+      The number of bytes written to the output buffer.
     """
 
-    br = io.BinaryReader(inStream)
-    self.m_hfTableLen = br.read_int16()
-    self.m_hfTableOffset = inStream.tell()
-    self.m_hfDataOffset = self.m_hfTableOffset + self.m_hfTableLen * 4 - 0x3fc
+    return self.DecodeLz(self.DecodeHuffman(inStream.read()), outBuffer)
 
-    super().ProcessOnDecode(inStream, outBuffer)
+  def DecodeToSink(self, src, outSize, sink, pos=0):
+    """Decodes Huffman-coded LZ data and passes the output to a sink in chunks.
 
-  def ReadByte(self, s):
-    """Reads a byte from the stream using Huffman coding.
+    The Huffman-coded bytes are decoded a chunk at a time and fed to the
+    LZ decoder as it needs them, so only a window of the LZ data and of
+    the output is kept in memory, whatever the output size.
 
     Args:
-      s: A stream containing the input data.
+      src: A bytes-like object (such as an mmap) holding the compressed data.
+      outSize: The decoded size.
+      sink: A callable taking each chunk of output.
+      pos: The offset of the compressed data in src.
 
     Returns:
-      A byte representing the byte read.
+      The number of bytes passed to the sink.
+    """
+
+    with memoryview(src) as view:
+      chunks = self.IterHuffman(view[pos:])
+      lz = b""
+
+      def Refill(p):
+        nonlocal lz
+        lz = lz[p:]
+        while len(lz) < JPK_STREAM_INPUT_MARGIN:
+          chunk = next(chunks, None)
+          if chunk is None:
+            return lz, 0, True
+          lz += chunk
+        return lz, 0, False
+
+      try:
+        return self.StreamLz(b"", outSize, sink, 0, Refill)
+      finally:
+        chunks.close()
+
+  def DecodeInto(self, src, outBuffer, pos=0):
+    """Decodes Huffman-coded LZ data into a writable buffer of the decoded size.
+
+    Args:
+      src: A bytes-like object (such as an mmap) holding the compressed data.
+      outBuffer: A writable buffer (such as an mmap of the output file) of the decoded size.
+      pos: The offset of the compressed data in src.
+
+    Returns:
+      The number of bytes decoded.
+    """
+
+    with memoryview(src) as view:
+      lz = self.DecodeHuffman(view[pos:])
+    return self.DecodeLz(lz, outBuffer)
+
+  def DecodeHuffman(self, src, count=None):
+    """Decodes Huffman-coded bytes.
+
+    The data starts with the root node id as an int16, followed by the
+    table of (root - 0xFF) * 2 int16 child entries (leaves are the ids below
+    0x100) and the code bits, most significant bit first. The tree is only
+    walked once per distinct (node, input byte) pair; after that every
+    input byte is a single table lookup.
+
+    Args:
+      src: A bytes-like object holding the table and the coded data.
+      count: The number of bytes to decode, or None to decode until the
+        data runs out.
+
+    Returns:
+      A bytearray with the decoded bytes.
+    """
+
+    out = bytearray()
+    for chunk in self.IterHuffman(src, count):
+      out += chunk
+    return out
+
+  def IterHuffman(self, src, count=None, chunkSize=JPK_STREAM_CHUNK):
+    """Decodes Huffman-coded bytes in chunks.
+
+    Args:
+      src: A bytes-like object holding the table and the coded data.
+      count: The number of bytes to decode, or None to decode until the
+        data runs out.
+      chunkSize: The number of coded bytes decoded per chunk.
+
+    Yields:
+      A bytearray with the bytes decoded from each chunk of coded data.
+    """
+
+    root = struct.unpack_from("<h", src, 0)[0]
+    entries = max(root - 0xFF, 0) * 2
+    table = struct.unpack_from(f"<{entries}h", src, 2)
+    dataOffset = 2 + entries * 2
+
+    # Transitions from an internal node over one whole input byte: the
+    # bytes completed along the way and the node the walk ends on, which
+    # carries codes longer than the rest of the byte into the next one.
+    # Entries are filled in the first time a (node, byte) pair is seen.
+    outputs = [None] * (entries << 7)
+    states = [0] * (entries << 7)
+
+    state = (root - 0x100) << 8
+    produced = 0
+    with memoryview(src) as view:
+      for start in range(dataOffset, len(view), chunkSize):
+        out = bytearray()
+        for byte in view[start:start + chunkSize]:
+          key = state | byte
+          done = outputs[key]
+          if done is None:
+            done, node = self.WalkHuffman(table, root, (key >> 8) + 0x100, byte)
+            outputs[key] = done
+            states[key] = (node - 0x100) << 8
+          out += done
+          state = states[key]
+
+        if count is not None and produced + len(out) >= count:
+          del out[count - produced:]
+          yield out
+          return
+        produced += len(out)
+        yield out
+
+  def WalkHuffman(self, table, root, node, byte):
+    """Walks the Huffman tree over the eight bits of one byte.
+
+    Args:
+      table: The Huffman table.
+      root: The root node id.
+      node: The internal node the walk starts on.
+      byte: The input byte.
+
+    Returns:
+      A tuple of the bytes decoded and the internal node the walk ends on.
     """
 
-    data = self.m_hfTableLen
-    br = io.BinaryReader(s)
+    done = bytearray()
+    for shift in range(7, -1, -1):
+      node = table[(node - 0x100) * 2 + ((byte >> shift) & 1)]
+      if node < 0x100:
+        done.append(node)
+        node = root
+    return bytes(done), node
+
+
+
+def ByteFrequencies(data):
+  """Counts how often each byte value occurs.
+
+  Args:
+    data: A bytes-like object.
+
+  Returns:
+    A list of 256 counts.
+  """
+
+  if np is not None:
+    return np.bincount(np.frombuffer(data, dtype=np.uint8), minlength=256).tolist()
+
+  freq = [0] * 256
+  for b, n in collections.Counter(data).items():
+    freq[b] = n
+  return freq
+
+
+
+def HuffmanLengths(freq, limit=JPK_HUFFMAN_MAX_BITS):
+  """Computes length-limited Huffman code lengths.
+
+  At least two symbols always get a code, so the tree has a root node even
+  for empty or single-valued input. Codes longer than limit are shortened
+  by moving leaves up the tree (as in JPEG's Annex K.3), which keeps the
+  code complete.
+
+  Args:
+    freq: A list of 256 symbol frequencies.
+    limit: The maximum code length in bits.
 
-    while data >= 0x100:
-      self.m_flagShift -= 1
-      if self.m_flagShift < 0:
-        self.m_flagShift = 7
-        s.seek(self.m_hfDataOffset)
-        self.m_flagHF = br.read_byte()
+  Returns:
+    A list of 256 code lengths, 0 for symbols without a code.
+  """
 
-      bit = (self.m_flagHF >> self.m_flagShift) & 0x1
-      s.seek((data * 2 - 0x200 + bit) * 2 + self.m_hfTableOffset)
-      data = br.read_int16()
+  used = [b for b in range(256) if freq[b]]
+  for b in range(256):
+    if len(used) >= 2:
+      break
+    if b not in used:
+      used.append(b)
+
+  # Plain Huffman tree; count the leaves at each depth.
+  heap = [(freq[b], b, [b]) for b in used]
+  heapq.heapify(heap)
+  depth = [0] * 256
+  tiebreak = 256
+  while len(heap) > 1:
+    f1, _, a = heapq.heappop(heap)
+    f2, _, b = heapq.heappop(heap)
+    for sym in a + b:
+      depth[sym] += 1
+    heapq.heappush(heap, (f1 + f2, tiebreak, a + b))
+    tiebreak += 1
+
+  maxDepth = max(depth[b] for b in used)
+  bits = [0] * (max(maxDepth, limit) + 1)
+  for b in used:
+    bits[depth[b]] += 1
+
+  for i in range(maxDepth, limit, -1):
+    while bits[i] > 0:
+      j = i - 2
+      while bits[j] == 0:
+        j -= 1
+      bits[i] -= 2
+      bits[i - 1] += 1
+      bits[j + 1] += 2
+      bits[j] -= 1
+
+  # Hand the shortest codes to the most frequent symbols.
+  lengths = [0] * 256
+  order = sorted(used, key=lambda b: (-freq[b], b))
+  length = 1
+  for b in order:
+    while bits[length] == 0:
+      length += 1
+    lengths[b] = length
+    bits[length] -= 1
+
+  return lengths
 
-    return 0xff & data
-  
 
 
 class JPKEncodeHFI(JPKEncodeLz):
   """A class for encoding JPK files using the LZ algorithm with Huffman coding.
 
-  This class inherits from the `JPKEncodeLz` class and overrides the `ProcessOnEncode()`, `WriteByte()`, and `WriteBit()` methods
-  to support Huffman coding.
+  This class inherits from the `JPKEncodeLz` class. The LZ tokens are
+  serialized in memory first, so the Huffman table can be fitted to their
+  byte frequencies, and are then written as the table followed by the
+  coded bytes.
 
   Attributes:
-    m_bits: The current bit buffer.
-    m_bitcount: The number of bits in the current bit buffer.
+    m_hfTable: The Huffman table, two child ids per internal node.
+    m_hfTableLen: The root node id.
+    m_Paths: The code of each byte value.
+    m_Lengths: The code length in bits of each byte value (0 if unused).
   """
 
-  def __init__(self):
-    super().__init__()
+  def __init__(self, depth=None, finder=None, optimal=None, nice=JPK_MAX_MATCH, lazy=False, deadline=None):
+    super().__init__(depth, finder, optimal, nice, lazy, deadline)
 
-    self.m_bits = 0
-    self.m_bitcount = 0
+    self.m_hfTable = []
+    self.m_hfTableLen = 0
+    self.m_Paths = array("I", [0]) * 256
+    self.m_Lengths = array("B", [0]) * 256
 
-  def ProcessOnEncode(self, inBuffer, outStream, level=16, showProgress=None):
-    """Encodes the input buffer to the output stream using the LZ algorithm with Huffman coding.
+  def EncodeTokens(self, tokens, outStream):
+    """Writes LZ tokens to the output stream with Huffman coding.
+
+    The Huffman table is fitted to the serialized tokens, so it reflects
+    the real symbol frequencies without parsing the input again.
 
     Args:
-      inBuffer: A bytearray containing the input data.
+      tokens: An LzTokens object.
       outStream: A stream to write the encoded data to.
-      level: The compression level.
-      showProgress: A callback function to show the progress of the encoding.
-
-    Returns:
-      None.
     """
 
-    self.FillTable()
-    br = io.BufferedWriter(outStream)
-    br.write(self.m_hfTableLen.to_bytes(2, 'big'))
-    for i in range(self.m_hfTableLen):
-      br.write(self.m_hfTable[i].to_bytes(1, 'big'))
+    data = tokens.Serialize()
+
+    self.FillTable(data)
+    self.WriteTable(outStream)
+    self.WriteHuffman(outStream, data)
 
-    super().ProcessOnEncode(inBuffer, outStream, level, showProgress)
-    self.FlushWrite(outStream)
-    br.flush()
+  def FillTable(self, data, limit=JPK_HUFFMAN_MAX_BITS):
+    """Builds a length-limited Huffman table for the bytes of a buffer.
 
-  def WriteBit(self, s, b):
-    """Writes a bit to the stream.
+    Code lengths come from a Huffman tree over the byte frequencies, capped
+    at limit bits, and are turned into canonical codes. The codes are then
+    laid out as the tree JPKDecodeHFI walks: internal nodes numbered from
+    0x100 with the root last, so the root id is also the table size.
 
     Args:
-      s: A stream to write to.
-      b: The bit to write.
+      data: A bytes-like object with the bytes to be coded.
+      limit: The maximum code length in bits.
+    """
 
-    Returns:
-      None.
+    lengths = HuffmanLengths(ByteFrequencies(data), limit)
+
+    # Assign canonical codes, shortest first.
+    symbols = sorted((lengths[b], b) for b in range(256) if lengths[b])
+    code = 0
+    prevLen = symbols[0][0]
+    for length, b in symbols:
+      code <<= length - prevLen
+      prevLen = length
+      self.m_Paths[b] = code
+      self.m_Lengths[b] = length
+      code += 1
+    for b in range(256):
+      if not lengths[b]:
+        self.m_Paths[b] = 0
+        self.m_Lengths[b] = 0
+
+    # Build the tree from the codes and number its internal nodes children first.
+    tree = [None, None]
+    for length, b in symbols:
+      node = tree
+      code = self.m_Paths[b]
+      for shift in range(length - 1, 0, -1):
+        bit = (code >> shift) & 1
+        if node[bit] is None:
+          node[bit] = [None, None]
+        node = node[bit]
+      node[code & 1] = b
+
+    table = []
+    def Number(node):
+      children = [child if isinstance(child, int) else Number(child) for child in node]
+      table.extend(children)
+      return 0xFF + len(table) // 2
+
+    self.m_hfTableLen = Number(tree)
+    self.m_hfTable = table
+
+  def WriteTable(self, s):
+    """Writes the root node id and the Huffman table.
+
+    Args:
+      s: A stream to write to.
     """
 
-    if self.m_bitcount == 8:
-      s.write(self.m_bits.to_bytes(1, 'big'))
-      self.m_bits = 0
-      self.m_bitcount = 0
+    s.write(struct.pack(f"<h{len(self.m_hfTable)}h", self.m_hfTableLen, *self.m_hfTable))
 
-    self.m_bits <<= 1
-    self.m_bits |= b
-    self.m_bitcount += 1
+  def WriteHuffman(self, s, data):
+    """Writes bytes as Huffman codes, most significant bit first.
 
-  def WriteBits(self, s, bits, len):
-    """Writes multiple bits to the stream.
+    Codes are packed into an integer accumulator that is flushed 32 bits
+    at a time, or whole blocks at a time with NumPy, and the last byte is
+    padded with zero bits.
 
     Args:
       s: A stream to write to.
-      bits: The bits to write.
-      len: The number of bits to write.
-
-    Returns:
-      None.
+      data: The bytes to code.
     """
 
-    while len > 0:
-      len -= 1
-      self.WriteBit(s, (bits >> len) & 1)
+    if np is not None and len(data) >= 4096:
+      self.WriteHuffmanNumpy(s, data)
+      return
 
-  def FlushWrite(self, s):
-    """Flushes the current bit buffer to the stream.
+    paths = self.m_Paths
+    lengths = self.m_Lengths
+    out = bytearray()
+    acc = 0
+    nbits = 0
 
-    Args:
-      s: A stream to write to.
+    for b in data:
+      acc = (acc << lengths[b]) | paths[b]
+      nbits += lengths[b]
+      if nbits >= 32:
+        nbits -= 32
+        out += (acc >> nbits).to_bytes(4, "big")
+        acc &= (1 << nbits) - 1
 
-    Returns:
-      None.
-    """
+    if nbits:
+      pad = -nbits % 8
+      out += (acc << pad).to_bytes((nbits + pad) // 8, "big")
 
-    if self.m_bitcount > 0:
-      self.m_bits <<= (8 - self.m_bitcount)
-      s.write(self.m_bits.to_bytes(1, 'big'))
+    s.write(out)
 
-  def WriteByte(self, s, b):
-    """Writes a byte to the stream using Huffman coding.
+  def WriteHuffmanNumpy(self, s, data):
+    """Writes bytes as Huffman codes with NumPy array operations.
+
+    Every code is spread over a row of JPK_HUFFMAN_MAX_BITS bits, the rows
+    are cut to the code lengths and the remaining bits packed into bytes.
+    The bits of a block that do not fill a byte are carried into the next
+    block.
 
     Args:
       s: A stream to write to.
-      b: The byte to write.
-
-    Returns:
-      None.
+      data: The bytes to code.
     """
 
-    bits = self.m_Paths[b]
-    len = self.m_Lengths[b]
-    self.WriteBits(s, bits, len)
+    width = JPK_HUFFMAN_MAX_BITS
+    lengths = np.array(self.m_Lengths, dtype=np.uint8)
+    aligned = np.array(self.m_Paths, dtype=np.uint32) << (width - lengths.astype(np.uint32))
+    shifts = np.arange(width - 1, -1, -1, dtype=np.uint32)
+    columns = np.arange(width, dtype=np.uint8)
+    symbols = np.frombuffer(data, dtype=np.uint8)
+    carry = np.zeros(0, dtype=np.uint8)
+
+    for start in range(0, len(symbols), JPK_HUFFMAN_NUMPY_BLOCK):
+      block = symbols[start:start + JPK_HUFFMAN_NUMPY_BLOCK]
+      rows = ((aligned[block][:, None] >> shifts) & 1).astype(np.uint8)
+      bits = np.concatenate((carry, rows[columns < lengths[block][:, None]]))
+      whole = len(bits) & ~7
+      s.write(np.packbits(bits[:whole]).tobytes())
+      carry = bits[whole:]
 
+    if len(carry):
+      s.write(np.packbits(carry).tobytes())
 
 
 
 class JPKDecodeHFIRW(JPKDecodeHFI):
-  """A class for decoding JPK files using the LZ algorithm with Huffman coding, using a read-write stream."""
+  """A class for decoding JPK files with Huffman coding only (no LZ)."""
 
   def ProcessOnDecode(self, inStream, outBuffer):
-    """Decodes the input stream to the output buffer using the LZ algorithm with Huffman coding.
+    """Decodes the input stream to the output buffer using Huffman coding.
 
     Args:
       inStream: A stream containing the input data.
       outBuffer: A bytearray to write the decoded data to.
 
     Returns:
-      None.
+      The number of bytes written to the output buffer.
+    """
+
+    data = self.DecodeHuffman(inStream.read(), len(outBuffer))
+    outBuffer[:len(data)] = data
+    return len(data)
+
+  def DecodeToSink(self, src, outSize, sink, pos=0):
+    """Decodes Huffman-coded data and passes the output to a sink in chunks.
+
+    Args:
+      src: A bytes-like object (such as an mmap) holding the compressed data.
+      outSize: The decoded size.
+      sink: A callable taking each chunk of output.
+      pos: The offset of the compressed data in src.
+
+    Returns:
+      The number of bytes passed to the sink.
+    """
+
+    total = 0
+    with memoryview(src) as view:
+      for chunk in self.IterHuffman(view[pos:], outSize):
+        sink(chunk)
+        total += len(chunk)
+    return total
+
+  def DecodeInto(self, src, outBuffer, pos=0):
+    """Decodes Huffman-coded data into a writable buffer of the decoded size.
+
+    Args:
+      src: A bytes-like object (such as an mmap) holding the compressed data.
+      outBuffer: A writable buffer (such as an mmap of the output file) of the decoded size.
+      pos: The offset of the compressed data in src.
+
+    Returns:
+      The number of bytes decoded.
     """
 
-    index = 0
-    while index < len(outBuffer):
-      outBuffer[index] = super().ReadByte(inStream)
-      index += 1
+    total = 0
+    with memoryview(src) as view:
+      for chunk in self.IterHuffman(view[pos:], len(outBuffer)):
+        outBuffer[total:total + len(chunk)] = chunk
+        total += len(chunk)
+    return total
 
 
 
 class JPKEncodeHFIRW(JPKEncodeHFI):
-  """A class for encoding JPK files using the LZ algorithm with Huffman coding, using a read-write stream."""
+  """A class for encoding JPK files with Huffman coding only (no LZ)."""
 
   def ProcessOnEncode(self, inBuffer, outStream, level=16, showProgress=None):
-    """Encodes the input buffer to the output stream using the LZ algorithm with Huffman coding.
+    """Encodes the input buffer to the output stream using Huffman coding.
 
     Args:
       inBuffer: A bytearray containing the input data.
       outStream: A stream to write the encoded data to.
-      level: The compression level.
+      level: The compression level (unused, Huffman coding has no levels).
       showProgress: A callback function to show the progress of the encoding.
 
     Returns:
       None.
     """
 
-    pass
+    if showProgress:
+      showProgress(0)
+
+    data = bytes(inBuffer)
+    self.FillTable(data)
+    self.WriteTable(outStream)
+    self.WriteHuffman(outStream, data)
+
+    if showProgress:
+      showProgress(100)
 
 
 
@@ -614,13 +2193,46 @@ class JPKDecodeRW(IJPKDecode):
       outBuffer: A bytearray to write the decoded data to.
 
     Returns:
-      None.
+      The number of bytes written to the output buffer.
+    """
+
+    data = inStream.read(len(outBuffer))
+    outBuffer[:len(data)] = data
+    return len(data)
+
+  def DecodeToSink(self, src, outSize, sink, pos=0):
+    """Passes the stored data to a sink in chunks.
+
+    Args:
+      src: A bytes-like object (such as an mmap) holding the data.
+      outSize: The decoded size.
+      sink: A callable taking each chunk of output.
+      pos: The offset of the data in src.
+
+    Returns:
+      The number of bytes passed to the sink.
     """
 
-    index = 0
-    while inStream.tell() < inStream.length and index < len(outBuffer):
-      outBuffer[index] = self.ReadByte(inStream)
-      index += 1
+    end = min(pos + outSize, len(src))
+    for start in range(pos, end, JPK_STREAM_CHUNK):
+      sink(src[start:min(start + JPK_STREAM_CHUNK, end)])
+    return max(end - pos, 0)
+
+  def DecodeInto(self, src, outBuffer, pos=0):
+    """Copies the stored data into a writable buffer of the decoded size.
+
+    Args:
+      src: A bytes-like object (such as an mmap) holding the data.
+      outBuffer: A writable buffer (such as an mmap of the output file) of the decoded size.
+      pos: The offset of the data in src.
+
+    Returns:
+      The number of bytes copied.
+    """
+
+    n = max(min(len(outBuffer), len(src) - pos), 0)
+    outBuffer[:n] = src[pos:pos + n]
+    return n
 
   def ReadByte(self, s):
     """Reads a byte from the stream.
@@ -656,18 +2268,15 @@ class JPKEncodeRW(IJPKEncode):
       None.
     """
 
-    perc, perc0 = 0, 0
     if showProgress is not None:
-      showProgress(perc)
-
-    for iin in range(len(inBuffer)):
-      perc = int(100 * iin / len(inBuffer))
-      if perc > perc0:
-        perc0 = perc
-        if showProgress is not None:
-          showProgress(perc)
-
-      self.WriteByte(outStream, inBuffer[iin])
+      showProgress(0)
+
+    # Raw data is copied through in chunks, with progress per chunk.
+    size = len(inBuffer)
+    for start in range(0, size, JPK_STREAM_CHUNK):
+      outStream.write(inBuffer[start:start + JPK_STREAM_CHUNK])
+      if showProgress is not None:
+        showProgress(100 * min(start + JPK_STREAM_CHUNK, size) // size)
 
     if showProgress is not None:
       showProgress(100)
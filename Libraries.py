@@ -129,22 +129,29 @@ def MatchArrays(haystack, needle, start):
         return False
     return True
   
-def CheckForMagic(header_int, data):
+def CheckForMagic(header_int, data, size=None):
   """Returns the file extension for files without a unique 4-byte magic, or None if not found.
 
   Args:
     header_int: The first 4 bytes of the file, as a Python integer.
-    data: The entire file contents, as a Python byte array.
+    data: The file contents, as a Python byte array. Only the first 12 bytes are needed if size is given.
+    size: The size of the file, or None to use len(data).
 
   Returns:
     A string representing the file extension, or None if not found.
   """
 
   header = data[:12]
+  if size is None:
+    size = len(data)
+
+  extension = None
+  if len(header) < 12:
+    return extension
 
   if header_int == 1:
-    extension = "fmod" if struct.unpack("<L", header[8:])[0] == len(data) else None
+    extension = "fmod" if struct.unpack("<L", header[8:])[0] == size else None
   elif header_int == 0xC0000000:
-    extension = "fskl" if struct.unpack("<L", header[8:])[0] == len(data) else None
+    extension = "fskl" if struct.unpack("<L", header[8:])[0] == size else None
 
   return extension
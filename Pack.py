@@ -1,9 +1,26 @@
 import io
 import os
+import csv
+import collections
+import time
 import struct
 import datetime
+from concurrent.futures import ProcessPoolExecutor
 from JPK import *
 
+# Levels -compress auto tries types 3 and 4 at.
+JPK_AUTO_LEVELS = (1000, 10000)
+
+# Files larger than this are trialled on a sample of this size.
+JPK_AUTO_SAMPLE = 1 << 20
+
+# Files whose trials jpk_encode_auto_batch keeps queued per worker.
+JPK_AUTO_FILES_PER_WORKER = 2
+
+# Where -compress auto records the type and level it chose for each file.
+JPK_MANIFEST_PATH = os.path.join("output", "jpk_manifest.csv")
+JPK_MANIFEST_FIELDS = ["file", "type", "level", "in_size", "out_size", "decode_ms", "sampled"]
+
 def process_pack_input(input_path):
   """Processes the input for a packed file.
 
@@ -178,7 +195,7 @@ def process_stage_container_archive(input_path, log_content):
 
         offset += len(entry_data)
 
-def jpk_encode(atype, in_path, out_path, level):
+def jpk_encode(atype, in_path, out_path, level, effort=None, deadline=None, stats=None):
   """Encodes a file using the JPK format.
 
   Args:
@@ -186,15 +203,34 @@ def jpk_encode(atype, in_path, out_path, level):
     in_path: The path to the input file.
     out_path: The path to the output file.
     level: The compression level to use (0-9).
+    effort: The name of a preset in JPK_EFFORT_PRESETS that replaces the level, or None.
+    deadline: A JPKDeadline shared by a batch of files, or None. Only types 3 and 4 use it.
+    stats: A JPKStats to report the progress and statistics to, or None.
   """
 
   # Create the output directory if it does not exist.
-  if not os.path.exists("output"):
-    os.makedirs("output")
+  out_dir = os.path.dirname(out_path) or "output"
+  if not os.path.exists(out_dir):
+    os.makedirs(out_dir)
 
   type = atype
-  buffer = open(in_path, "rb").read()
-  in_size = len(buffer)
+
+  # Settings for the LZ encoders.
+  settings = {}
+  if effort is not None:
+    preset = JPK_EFFORT_PRESETS[effort]
+    level = preset["level"]
+    settings = {"depth": preset["depth"], "nice": preset["nice"], "lazy": preset["lazy"]}
+  if deadline is not None:
+    settings["deadline"] = deadline
+
+  # Greedy LZ is streamed from the input file; the other encoders need it all in memory.
+  stream = type == 3 and (level < JPK_OPTIMAL_LEVEL or deadline is not None)
+  buffer = None
+  in_size = 0
+  if not stream:
+    buffer = open(in_path, "rb").read()
+    in_size = len(buffer)
 
   # Delete the output file if it exists.
   if os.path.exists(out_path):
@@ -203,36 +239,49 @@ def jpk_encode(atype, in_path, out_path, level):
   # Create a file stream to the output file.
   fsot = open(out_path, "wb")
 
-  # Create a binary writer to the file stream.
-  br = io.BufferedWriter(fsot)
-
   # Write the header to the output file.
-  br.write(struct.pack("<I", 0x1A524B4A))
-  br.write(struct.pack("<H", 0x108))
-  br.write(struct.pack("<H", type))
-  br.write(struct.pack("<I", 0x10))
-  br.write(struct.pack("<I", in_size))
+  fsot.write(struct.pack("<I", 0x1A524B4A))
+  fsot.write(struct.pack("<H", 0x108))
+  fsot.write(struct.pack("<H", type))
+  fsot.write(struct.pack("<I", 0x10))
+  fsot.write(struct.pack("<I", in_size))
 
   # Get the appropriate JPK encoder based on the type.
   encoder = None
   if type == 0:
     encoder = JPKEncodeRW()
   elif type == 2:
-    #encoder = new JPKEncodeHFIRW();
-    pass
+    encoder = JPKEncodeHFIRW()
   elif type == 3:
-    encoder = JPKEncodeLz()
+    encoder = JPKEncodeLz(**settings)
   elif type == 4:
-    encoder = JPKEncodeHFI()
+    encoder = JPKEncodeHFI(**settings)
 
   # If an encoder was found, encode the file.
   if encoder is not None:
+    if stats is not None:
+      encoder.m_stats = stats
+      stats.Begin("encode", type, in_size if not stream else os.path.getsize(in_path))
+
     start_time = datetime.datetime.now()
-    encoder.process_on_encode(buffer, fsot, level, None)
+    if stream:
+      with open(in_path, "rb") as fsin:
+        in_size = encoder.EncodeStream(fsin, fsot, level, stats)
+
+      # Patch the out_size field of the header.
+      end = fsot.tell()
+      fsot.seek(12)
+      fsot.write(struct.pack("<I", in_size))
+      fsot.seek(end)
+    else:
+      encoder.ProcessOnEncode(buffer, fsot, level, stats)
     end_time = datetime.datetime.now()
 
+    if stats is not None:
+      stats.End(in_size, fsot.tell())
+
     # Print the compression statistics.
-    print(f"File compressed using type {type} (level {level / 100}): {fsot.tell()} bytes ({1 - (fsot.tell() / in_size):P} saved) in {(end_time - start_time).total_seconds()} seconds")
+    print(f"File compressed using type {type} (level {effort or level / 100}): {fsot.tell()} bytes ({1 - (fsot.tell() / in_size) if in_size else 0:.2%} saved) in {(end_time - start_time).total_seconds()} seconds")
 
     # Close the file stream.
     fsot.close()
@@ -243,4 +292,228 @@ def jpk_encode(atype, in_path, out_path, level):
     fsot.close()
 
     # Delete the output file.
-    os.remove(out_path)
\ No newline at end of file
+    os.remove(out_path)
+
+
+def trial_encode(job):
+  """Compresses data with one candidate encoder and times its decoding.
+
+  Runs in a worker process for jpk_choose_encoding. Types 3 and 4 at the
+  same level share one LZ parse.
+
+  Args:
+    job: A tuple of the encoder family ("raw", "huffman" or "lz"), the data and the level.
+
+  Returns:
+    A list of (type, level, compressed size, decode seconds, payload) tuples.
+  """
+
+  family, data, level = job
+  results = []
+
+  def Record(type, payload, decoder):
+    out_buffer = bytearray(len(data))
+    start_time = time.perf_counter()
+    decoder.ProcessOnDecode(io.BytesIO(payload), out_buffer)
+    results.append((type, level, len(payload), time.perf_counter() - start_time, payload))
+
+  if family == "raw":
+    Record(0, bytes(data), JPKDecodeRW())
+  elif family == "huffman":
+    ms = io.BytesIO()
+    JPKEncodeHFIRW().ProcessOnEncode(data, ms, level)
+    Record(2, ms.getvalue(), JPKDecodeHFIRW())
+  else:
+    encoder = JPKEncodeHFI()
+    tokens = encoder.Tokenize(data, level)
+    Record(3, bytes(tokens.Serialize()), JPKDecodeLz())
+    ms = io.BytesIO()
+    encoder.EncodeTokens(tokens, ms)
+    Record(4, ms.getvalue(), JPKDecodeHFI())
+
+  return results
+
+def jpk_sample(buffer, sample_size=JPK_AUTO_SAMPLE):
+  """Returns the data the auto mode runs its trials on.
+
+  Args:
+    buffer: The file contents.
+    sample_size: The largest sample, or None to always use the whole file.
+
+  Returns:
+    The whole buffer if it is small enough, otherwise four evenly spaced
+    slices of it joined together.
+  """
+
+  if sample_size is None or len(buffer) <= sample_size:
+    return buffer
+
+  piece = sample_size // 4
+  step = (len(buffer) - piece) // 3
+  return b"".join(buffer[i * step:i * step + piece] for i in range(4))
+
+def jpk_choose_encoding(buffer, levels=JPK_AUTO_LEVELS, tolerance=0.0, workers=None, sample_size=JPK_AUTO_SAMPLE, pool=None):
+  """Picks the JPK type and level for a file by trial compression.
+
+  Every type (0, 2, 3 and 4, the LZ types at each level) is tried on a
+  process pool. The smallest result wins, unless a result within
+  tolerance of it decodes faster.
+
+  Args:
+    buffer: The file contents.
+    levels: The levels to try types 3 and 4 at.
+    tolerance: How much larger than the smallest result a faster-decoding one may be, e.g. 0.05 for 5%.
+    workers: The number of worker processes, or None for one per CPU.
+    sample_size: The largest sample to run the trials on, or None for the whole file.
+    pool: A ProcessPoolExecutor shared by a batch of files, or None to start one for this file.
+
+  Returns:
+    A tuple of the chosen (type, level, size, decode seconds, payload)
+    and whether the trials ran on the whole file.
+  """
+
+  jobs, whole = jpk_trial_jobs(buffer, levels, sample_size)
+
+  if pool is None:
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      results = [result for job_results in pool.map(trial_encode, jobs) for result in job_results]
+  else:
+    results = [result for job_results in pool.map(trial_encode, jobs) for result in job_results]
+
+  return jpk_pick_encoding(results, tolerance), whole
+
+def jpk_trial_jobs(buffer, levels=JPK_AUTO_LEVELS, sample_size=JPK_AUTO_SAMPLE):
+  """Returns the trial_encode jobs for a file.
+
+  Args:
+    buffer: The file contents.
+    levels: The levels to try types 3 and 4 at.
+    sample_size: The largest sample to run the trials on, or None for the whole file.
+
+  Returns:
+    A tuple of the list of jobs and whether they run on the whole file.
+  """
+
+  data = jpk_sample(buffer, sample_size)
+  jobs = [("raw", data, 0), ("huffman", data, 0)] + [("lz", data, level) for level in levels]
+  return jobs, data is buffer
+
+def jpk_pick_encoding(results, tolerance=0.0):
+  """Picks the smallest trial result, or a faster-decoding one within tolerance of it.
+
+  Args:
+    results: The (type, level, size, decode seconds, payload) tuples of the trials.
+    tolerance: How much larger than the smallest result a faster-decoding one may be.
+
+  Returns:
+    The chosen tuple.
+  """
+
+  smallest = min(result[2] for result in results)
+  candidates = [result for result in results if result[2] <= smallest * (1 + tolerance)]
+  return min(candidates, key=lambda result: (result[3], result[2]))
+
+def write_jpk(out_path, type, in_size, payload):
+  """Writes a JPK file from an encoded payload.
+
+  Args:
+    out_path: The path to the output file.
+    type: The JPK type.
+    in_size: The decoded size.
+    payload: The encoded data.
+  """
+
+  with open(out_path, "wb") as fsot:
+    fsot.write(struct.pack("<IHHII", 0x1A524B4A, 0x108, type, 0x10, in_size))
+    fsot.write(payload)
+
+def jpk_reset_manifest(manifest_path=JPK_MANIFEST_PATH):
+  """Starts a new pack manifest, replacing the rows of earlier runs.
+
+  Args:
+    manifest_path: The path to the manifest CSV file.
+  """
+
+  if os.path.dirname(manifest_path):
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+  with open(manifest_path, "w", newline="") as f:
+    csv.writer(f, lineterminator="\n").writerow(JPK_MANIFEST_FIELDS)
+
+def jpk_encode_auto(in_path, out_path, tolerance=0.0, workers=None, sample_size=JPK_AUTO_SAMPLE, manifest_path=JPK_MANIFEST_PATH, pool=None, base_dir=None):
+  """Encodes a file with the JPK type and level chosen by trial compression.
+
+  The choice is appended to the pack manifest.
+
+  Args:
+    in_path: The path to the input file.
+    out_path: The path to the output file.
+    tolerance: How much larger than the smallest result a faster-decoding one may be.
+    workers: The number of worker processes, or None for one per CPU.
+    sample_size: The largest sample to run the trials on, or None for the whole file.
+    manifest_path: The path to the manifest CSV file.
+    pool: A ProcessPoolExecutor shared by a batch of files, or None to start one for this file.
+    base_dir: The input root the manifest path is made relative to, or None to record in_path as given.
+  """
+
+  jpk_encode_auto_batch([(in_path, out_path)], tolerance, workers, sample_size, manifest_path, pool, base_dir)
+
+def jpk_encode_auto_batch(files, tolerance=0.0, workers=None, sample_size=JPK_AUTO_SAMPLE, manifest_path=JPK_MANIFEST_PATH, pool=None, base_dir=None):
+  """Encodes files with the JPK type and level chosen by trial compression.
+
+  The trials of up to JPK_AUTO_FILES_PER_WORKER files per worker are
+  queued on the pool at once, so every worker has jobs even while one
+  file waits on its slowest trial. The files are still written, and their
+  choices appended to the pack manifest, in order.
+
+  Args:
+    files: A list of (input path, output path) tuples.
+    tolerance: How much larger than the smallest result a faster-decoding one may be.
+    workers: The number of worker processes, or None for one per CPU.
+    sample_size: The largest sample to run the trials on, or None for the whole file.
+    manifest_path: The path to the manifest CSV file.
+    pool: A ProcessPoolExecutor to run the trials on, or None to start one.
+    base_dir: The input root the manifest paths are made relative to, or None to record the input paths as given.
+  """
+
+  if pool is None:
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      return jpk_encode_auto_batch(files, tolerance, workers, sample_size, manifest_path, pool, base_dir)
+
+  ahead = JPK_AUTO_FILES_PER_WORKER * (workers or os.cpu_count() or 1)
+  pending = collections.deque()
+
+  def Finish():
+    in_path, out_path, in_size, whole, futures = pending.popleft()
+    results = [result for future in futures for result in future.result()]
+    type, level, size, decode_seconds, payload = jpk_pick_encoding(results, tolerance)
+
+    # The trials' payload can be written as is, unless they ran on a sample.
+    if whole:
+      write_jpk(out_path, type, in_size, payload)
+      print(f"File compressed using type {type} (level {level / 100}): {size + 0x10} bytes")
+    else:
+      jpk_encode(type, in_path, out_path, level)
+
+    # Record the choice in the manifest.
+    if not os.path.exists(manifest_path):
+      jpk_reset_manifest(manifest_path)
+    file = in_path if base_dir is None else os.path.relpath(in_path, base_dir)
+    with open(manifest_path, "a", newline="") as f:
+      csv.writer(f, lineterminator="\n").writerow([file, type, level, in_size, os.path.getsize(out_path), f"{decode_seconds * 1000:.3f}", int(not whole)])
+
+  for in_path, out_path in files:
+    # Create the output directories if they do not exist.
+    for out_dir in ("output", os.path.dirname(out_path)):
+      if out_dir and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    buffer = open(in_path, "rb").read()
+    jobs, whole = jpk_trial_jobs(buffer, sample_size=sample_size)
+    pending.append((in_path, out_path, len(buffer), whole, [pool.submit(trial_encode, job) for job in jobs]))
+    del buffer, jobs
+
+    if len(pending) > ahead:
+      Finish()
+
+  while pending:
+    Finish()
@@ -1,11 +1,13 @@
 import sys, os, io, re, threading
+from concurrent.futures import ProcessPoolExecutor
 from Libraries import *
 from Pack import *
 from Unpack import *
 from Crypto import *
+from Scanner import *
 
 recursive = True
-create_log, repack, decrypt_only, no_decryption, encrypt, auto_close, clean_up, compress, ignore_jpk, stage_container, auto_stage, mhfup = False
+create_log, repack, decrypt_only, no_decryption, encrypt, auto_close, clean_up, compress, ignore_jpk, stage_container, auto_stage, mhfup = (False,) * 12
 
 def main():
     
@@ -24,11 +26,20 @@ def main():
                        "-decryptOnly: Decrypt ecd files without unpacking\n" +
                        "-noDecryption: Don't decrypt ecd files, no unpacking\n" +
                        "-ignoreJPK: Do not decompress JPK files\n" +
+                       "-ecdBackend [name]: ECD decryption backend (table, reference)\n" +
                        "\nPacking Options:\n" +
                        "-pack: Repack directory (requires log file)\n" +
                        "-compress [type],[level]: Pack file with jpk [type] at compression [level]\n" +
+                       "-compress [type],[fast|normal|max]: Pack file with jpk [type] at an effort preset\n" +
+                       "-deadline [seconds]: Lower or raise the jpk effort to finish compressing within [seconds]\n" +
+                       "-compress auto[,tolerance]: Pack file with the jpk type and level that compress it best,\n" +
+                       "    or decode fastest within [tolerance] percent of the best\n" +
                        "-encrypt: Encrypt input file with ecd algorithm\n" +
+                       "-verifyEcd: Check the CRC32 of ecd files without decrypting them to disk\n" +
+                       "-scan: Classify every file in a directory by its header and update the format index\n" +
+                       "-jpkInfo: List the jpk type, ratio and decoded size of every jpk file and archive entry without decoding\n" +
                        "\nGeneral Options:\n" +
+                       "-jpkStats [path]: Write jpk progress, throughput and match statistics to [path] (default jpk_stats.json)\n" +
                        "-close: Close window after finishing process")
         sys.exit()
 
@@ -46,17 +57,56 @@ def main():
     stage_container = sys.argv.count("-stageContainer") > 0
     auto_stage = sys.argv.count("-autoStage") > 0
     mhfup = sys.argv.count("-mhfup") > 0
+    verify_ecd = sys.argv.count("-verifyEcd") > 0
+    scan = sys.argv.count("-scan") > 0
+    jpk_info = sys.argv.count("-jpkInfo") > 0
+
+    ## Get the ECD decryption backend from the command-line arguments
+    ecd_backend = "table"
+    if sys.argv.count("-ecdBackend") > 0:
+        ecd_backend = sys.argv[sys.argv.index("-ecdBackend") + 1]
+        if ecd_backend not in ecdDecoders:
+            print(f"ERROR: Unknown ECD backend: {ecd_backend}")
+            sys.exit()
+
+    ## Collect jpk statistics if specified, into the given path or jpk_stats.json
+    jpk_stats, jpk_stats_path = None, "jpk_stats.json"
+    if sys.argv.count("-jpkStats") > 0:
+        index = sys.argv.index("-jpkStats") + 1
+        if index < len(sys.argv) and not sys.argv[index].startswith("-"):
+            jpk_stats_path = sys.argv[index]
+        jpk_stats = JPKStats(PrintJPKProgress)
 
     ## Check if the input file exists
     if not os.path.exists(input_file):
         print("ERROR: Input file does not exist.")
         sys.exit()
 
+    ## If verifying ECD files is specified
+    if verify_ecd:
+
+        ## Check every ECD file in the input file or directory
+        VerifyEcdFiles(input_file)
+
+    ## If listing the jpk files is specified
+    elif jpk_info:
+
+        ## Read the JKR headers of the input file or directory, largest decoded size first
+        rows = InventoryJPK(input_file)
+        PrintJPKInventory(rows)
+
+    ## If scanning a directory is specified
+    elif scan and os.path.isdir(input_file):
+
+        ## Classify every file from its header, reusing the index for unchanged files
+        index, read = ScanDirectory(input_file)
+        PrintIndexSummary(index, read)
+
     ## If the input is a directory
-    if os.path.isdir(input_file):
+    elif os.path.isdir(input_file):
 
-        ## If repacking or encrypting is not specified
-        if not repack and not encrypt:
+        ## If repacking, encrypting or compressing is not specified
+        if not repack and not encrypt and not compress:
 
             ## Get a list of all the files in the input directory and its subdirectories
             input_files = os.listdir(input_file, recursive=True)
@@ -79,7 +129,7 @@ def main():
             else:
 
                 ## Process the input files
-                ProcessMultipleLevels(input_files)
+                ProcessMultipleLevels(input_files, ecd_backend=ecd_backend, jpk_stats=jpk_stats)
 
         ## If repacking is specified
         elif repack:
@@ -87,11 +137,11 @@ def main():
             ## Pack the input directory
             process_pack_input(input_file)
 
-        ## If encrypting is specified
+        ## If compressing is specified
         elif compress:
 
-            print("A directory was specified while in compression mode. Stopping.")
-            sys.exit()
+            ## Compress every file in the directory into the output directory
+            CompressFiles(input_file, [entry.path for entry in IterFiles(input_file)], jpk_stats)
 
         ## If encrypting is specified
         elif encrypt:
@@ -106,7 +156,7 @@ def main():
         if not repack and not encrypt and not compress:
 
             ## Process the input file
-            ProcessMultipleLevels([input_file])
+            ProcessMultipleLevels([input_file], ecd_backend=ecd_backend, jpk_stats=jpk_stats)
 
         ## If repacking is specified
         elif repack:
@@ -116,37 +166,19 @@ def main():
             sys.exit()
 
         elif compress:
-            try:
-                ## Get the compress type and level from the command-line arguments
-                pattern = r"-compress (\d+),(\d+)"
-                match = re.match(pattern, " ".join(sys.argv[1:]))
-                type = int(match.group(1))
-                level = int(match.group(2)) * 100
-
-                ## Compress the input file
-                jpk_encode(type, input_file, os.path.basename(input_file), level)
 
-            ## Otherwise, print an error message and exit
-            except:
-                print("ERROR: Check compress input. Example: -compress 3,50")
-                sys.exit()
+            ## Compress the input file into the output directory
+            CompressFiles(os.path.dirname(input_file), [input_file], jpk_stats)
 
         ## If encrypting is specified
         elif encrypt:
 
-            ## Open the input file and metadata file in binary mode
-            with open(input_file, "rb") as f:
-                buffer = f.read()
-
+            ## Open the metadata file in binary mode
             with open(f"{input_file}.meta", "rb") as f:
                 buffer_meta = f.read()
 
-            ## Encrypt the input file
-            buffer = encEcd(buffer, buffer_meta)
-
-            ## Open the input file in binary mode and write the encrypted file back to it
-            with open(input_file, "wb") as f:
-                f.write(buffer)
+            ## Encrypt the input file in place, streaming it through the cipher
+            encEcdFile(input_file, buffer_meta, input_file)
 
             ## Print a message indicating that the file has been encrypted
             print_message("File encrypted.", False)
@@ -154,8 +186,14 @@ def main():
             ## Get the update entry for the encrypted file
             GetUpdateEntry(input_file)
 
+    ## Write the jpk statistics
+    if jpk_stats is not None:
+        with open(jpk_stats_path, "w", encoding="utf-8") as f:
+            f.write(jpk_stats.Json())
+        print_message(f"JPK statistics written to {jpk_stats_path}.")
+
 
-def ProcessFile(input_file, create_log=False, clean_up=False, auto_stage=False, decrypt_only=False, ignore_jpk=False):
+def ProcessFile(input_file, create_log=False, clean_up=False, auto_stage=False, decrypt_only=False, ignore_jpk=False, ecd_backend="table", jpk_stats=None):
   """Processes a single file.
 
   Args:
@@ -165,22 +203,29 @@ def ProcessFile(input_file, create_log=False, clean_up=False, auto_stage=False,
     auto_stage: Whether to automatically stage the processed file.
     decrypt_only: Whether to only decrypt the file.
     ignore_jpk: Whether to ignore JKR files.
+    ecd_backend: The name of the ECD decryption backend (see ecdDecoders).
+    jpk_stats: A JPKStats to report jpk decoding to, or None.
   """
 
   print(f"Processing {input_file}")
 
-  # Read the file to memory.
-  with open(input_file, "rb") as f:
-    ms_input = io.BytesIO(f.read())
-    br_input = io.BufferedReader(ms_input)
+  # Classify the file from its first bytes.
+  file_info = SniffHeader(input_file)
 
   # If the file is empty, skip it.
-  if ms_input.length == 0:
+  if file_info["kind"] == "empty":
     print("File is empty. Skipping.")
     return
 
   # Get the file magic number.
-  file_magic = br_input.readint32()
+  file_magic = file_info.get("magic")
+
+  # Read the file to memory, unless it is decrypted or decompressed on disk.
+  br_input = None
+  if stage_container or file_info["kind"] not in ("ecd", "exf", "jkr"):
+    with open(input_file, "rb") as f:
+      ms_input = io.BytesIO(f.read())
+      br_input = io.BufferedReader(ms_input)
 
   # If the file is a stage container, unpack it.
   if stage_container:
@@ -199,19 +244,15 @@ def ProcessFile(input_file, create_log=False, clean_up=False, auto_stage=False,
   elif file_magic == 0x1A646365:
     print("ECD Header detected.")
 
-    # Decrypt the file.
+    # Decrypt the file in place and strip the ECD header from it.
     if not decrypt_only:
-      buffer = os.path.getsize(input_file)
-      data = br_input.read(buffer)
-      decEcd(data)
+      ecd_header = decEcdFile(input_file, ecd_backend)
 
-      # Strip the ECD header from the file.
-      ecd_header = data[:0x10]
-      data_stripped = data[0x10:]
-
-      # Write the stripped file back to disk.
-      with open(input_file, "wb") as f:
-        f.write(data_stripped)
+      # Stop if the file could not be decrypted, as it is left unchanged.
+      if ecd_header is None:
+        print("Not a valid ECD file. Skipping.")
+        print("==============================")
+        return
 
       # Create a log file for the processed file.
       if create_log:
@@ -224,14 +265,8 @@ def ProcessFile(input_file, create_log=False, clean_up=False, auto_stage=False,
   elif file_magic == 0x1A667865:
     print("EXF Header detected.")
 
-    # Decrypt the file.
-    buffer = os.path.getsize(input_file)
-    data = br_input.read(buffer)
-    decExf(data)
-
-    # Write the decrypted file back to disk.
-    with open(input_file, "wb") as f:
-      f.write(data)
+    # Decrypt the file in place.
+    decExfFile(input_file)
 
     print("File decrypted.")
 
@@ -241,8 +276,8 @@ def ProcessFile(input_file, create_log=False, clean_up=False, auto_stage=False,
 
     # Decompress the file.
     if not ignore_jpk:
-      UnpackJPK(input_file)
-      print("File decompressed.")
+      if UnpackJPK(input_file, jpk_stats):
+        print("File decompressed.")
 
   # If the file has a MHA header, unpack it.
   elif file_magic == 0x0161686D:
@@ -269,25 +304,144 @@ def ProcessFile(input_file, create_log=False, clean_up=False, auto_stage=False,
     # recursively process the file again.
   if file_magic == 0x1A646365 and not decrypt_only:
     print("==============================")
-    ProcessFile(input_file, create_log, clean_up, auto_stage, decrypt_only, ignore_jpk)
+    ProcessFile(input_file, create_log, clean_up, auto_stage, decrypt_only, ignore_jpk, ecd_backend, jpk_stats)
     return
 
   # Otherwise, print a separator line.
   else:
     print("==============================")
 
-def ProcessMultipleLevels(input_files, patterns=["*.bin", "*.jkr", "*.ftxt", "*.snd"], recursive=True):
+def VerifyEcdFileSafe(input_file):
+  """Runs verifyEcdFile on a worker, catching the errors of a single file.
+
+  Args:
+    input_file: The path to the file.
+
+  Returns:
+    A tuple of the result of verifyEcdFile (None on error) and the error text (None on success).
+  """
+
+  try:
+    return verifyEcdFile(input_file), None
+  except Exception as e:
+    return None, f"{type(e).__name__}: {e}"
+
+def VerifyEcdFiles(input_path, workers=None):
+  """Checks the CRC32 of every ECD file in a file or directory tree.
+
+  Files are decrypted in memory only, on a process pool, and nothing is
+  written back to disk. A file that cannot be read is reported as failed
+  with the error, and the other files are still checked.
+
+  Args:
+    input_path: The path to a file or a directory.
+    workers: The number of worker processes, or None for one per CPU.
+
+  Returns:
+    A list of the paths that failed the check.
+  """
+
+  # Collect the files to check.
+  if os.path.isdir(input_path):
+    input_files = [os.path.join(root, name) for root, dirs, files in os.walk(input_path) for name in files]
+  else:
+    input_files = [input_path]
+
+  checked = 0
+  bad_files = []
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    for input_file, (result, error) in zip(input_files, pool.map(VerifyEcdFileSafe, input_files, chunksize=16)):
+      # Report files that could not be checked.
+      if error is not None:
+        checked += 1
+        bad_files.append(input_file)
+        print(f"BAD: {input_file} ({error})")
+        continue
+
+      # Skip files without an ECD header.
+      if result is None:
+        continue
+
+      checked += 1
+      ok, expected, actual = result
+      if not ok:
+        bad_files.append(input_file)
+        if actual is None:
+          print(f"BAD: {input_file} (truncated)")
+        else:
+          print(f"BAD: {input_file} (expected CRC32 0x{expected:08X}, got 0x{actual:08X})")
+
+  print_message(f"Checked {checked} ECD files, {len(bad_files)} bad.")
+  return bad_files
+
+def PrintJPKProgress(event):
+  """Prints a progress event from a JPKStats.
+
+  Args:
+    event: The event dict.
+  """
+
+  print(f"JPK {event['operation']} (type {event['type']}): {event['percent']}% at {event['bytes_per_second'] / 1e6:.2f} MB/s")
+
+def CompressFiles(base_dir, input_files, jpk_stats=None):
+  """Compresses files with the jpk settings given on the command line.
+
+  With -deadline, one JPKDeadline covers all the files, so the effort
+  adapts across the whole batch. With -compress auto, the manifest is
+  started afresh and the trials of many files share one process pool.
+
+  Args:
+    base_dir: The directory the output paths are made relative to.
+    input_files: The paths to the files to compress.
+    jpk_stats: A JPKStats to report jpk encoding to, or None.
+  """
+
+  args = " ".join(sys.argv[1:])
+  try:
+    # Get the compress type and level or effort preset, unless they are chosen automatically.
+    auto = re.search(r"-compress auto(?:,(\d+(?:\.\d+)?))?", args)
+    if not auto:
+      match = re.search(r"-compress (\d+),(\d+|fast|normal|max)\b", args)
+      type = int(match.group(1))
+      effort = match.group(2) if match.group(2) in JPK_EFFORT_PRESETS else None
+      level = int(match.group(2)) * 100 if effort is None else None
+
+    # Get the time budget for the whole batch. Only the LZ types report
+    # their progress to the deadline, so it only covers their bytes.
+    deadline = None
+    match = re.search(r"-deadline (\d+(?:\.\d+)?)", args)
+    if match and not auto and type in (3, 4):
+      deadline = JPKDeadline(float(match.group(1)), sum(os.path.getsize(path) for path in input_files))
+
+  # Otherwise, print an error message and exit.
+  except:
+    print("ERROR: Check compress input. Example: -compress 3,50")
+    sys.exit()
+
+  if auto:
+    # Queue the trials of many files at once on one process pool.
+    jpk_reset_manifest()
+    files = [(input_file, os.path.join("output", os.path.relpath(input_file, base_dir or "."))) for input_file in input_files]
+    jpk_encode_auto_batch(files, float(auto.group(1) or 0) / 100, base_dir=base_dir or ".")
+  else:
+    for input_file in input_files:
+      out_path = os.path.join("output", os.path.relpath(input_file, base_dir or "."))
+      jpk_encode(type, input_file, out_path, level, effort, deadline, jpk_stats)
+
+def ProcessMultipleLevels(input_files, patterns=["*.bin", "*.jkr", "*.ftxt", "*.snd"], recursive=True, ecd_backend="table", jpk_stats=None):
   """Processes a set of files and all subdirectories.
 
   Args:
     input_files: A list of file paths.
     patterns: A list of file patterns to match.
     recursive: Whether to process subdirectories.
+    ecd_backend: The name of the ECD decryption backend (see ecdDecoders).
+    jpk_stats: A JPKStats to report jpk decoding to, or None.
   """
 
   # Current level
   for input_file in input_files:
-    ProcessFile(input_file)
+    ProcessFile(input_file, ecd_backend=ecd_backend, jpk_stats=jpk_stats)
 
     # Disable stage processing files unpacked from parent
     stage_container = False
@@ -300,7 +454,7 @@ def ProcessMultipleLevels(input_files, patterns=["*.bin", "*.jkr", "*.ftxt", "*.
         for subdirectory_file in os.listdir(directory):
           if pattern.endswith(os.path.splitext(subdirectory_file)[1]):
             subdirectory_files.append(os.path.join(directory, subdirectory_file))
-      ProcessMultipleLevels(subdirectory_files, patterns, recursive)
+      ProcessMultipleLevels(subdirectory_files, patterns, recursive, ecd_backend, jpk_stats)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
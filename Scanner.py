@@ -0,0 +1,306 @@
+import os
+import csv
+import json
+import struct
+from Libraries import *
+from JPK import ParseJPKHeader, ReadJPKHeader, JPK_HEADER_SIZE
+
+# Number of bytes read from the start of every file.
+HEADER_SNIFF_SIZE = 64
+
+# Default name of the index file written into a scanned directory.
+INDEX_FILE_NAME = ".refrontier_index.json"
+
+# Largest entry count of a simple archive, as checked by UnpackSimpleArchive.
+ARCHIVE_MAX_ENTRIES = 9999
+
+# Default path of the CSV file written by the JPK inventory.
+JPK_INVENTORY_PATH = os.path.join("output", "jpk_inventory.csv")
+
+# Magics handled by ReFrontier.ProcessFile, read as little-endian integers.
+FILE_KINDS = {
+  0x4F4D4F4D: "momo",
+  0x1A646365: "ecd",
+  0x1A667865: "exf",
+  0x1A524B4A: "jkr",
+  0x0161686D: "mha",
+  0x000B0000: "ftxt",
+}
+
+def ClassifyHeader(header, size):
+  """Classifies a file from its first bytes.
+
+  Args:
+    header: The first bytes of the file (at least 16 for full details).
+    size: The size of the file.
+
+  Returns:
+    A dict with the file kind ("ecd", "jkr", ..., or "unknown"), its
+    magic and extension, and the ECD size/crc32/key index or the JKR
+    type/start offset/out_size where they apply.
+  """
+
+  entry = {"kind": "empty" if size == 0 else "unknown", "extension": None}
+  if len(header) < 4:
+    return entry
+
+  magic = int.from_bytes(header[:4], "little")
+  entry["magic"] = magic
+  entry["kind"] = FILE_KINDS.get(magic, "unknown")
+
+  try:
+    entry["extension"] = Extensions(magic).name.lower()
+  except ValueError:
+    entry["extension"] = CheckForMagic(magic, header, size)
+
+  if len(header) >= 16:
+    if entry["kind"] == "ecd":
+      entry["key_index"] = int.from_bytes(header[4:6], "little")
+      entry["fsize"] = int.from_bytes(header[8:12], "little")
+      entry["crc32"] = int.from_bytes(header[12:16], "little")
+    elif entry["kind"] == "exf":
+      entry["key_index"] = int.from_bytes(header[4:6], "little")
+    elif entry["kind"] == "jkr":
+      entry.update(ParseJPKHeader(header))
+
+  return entry
+
+def SniffHeader(path, size=None):
+  """Classifies a file by reading only its first HEADER_SNIFF_SIZE bytes.
+
+  Args:
+    path: The path to the file.
+    size: The size of the file, or None to look it up.
+
+  Returns:
+    A dict as returned by ClassifyHeader.
+  """
+
+  if size is None:
+    size = os.path.getsize(path)
+  with open(path, "rb") as f:
+    header = f.read(HEADER_SNIFF_SIZE)
+  return ClassifyHeader(header, size)
+
+def IterFiles(directory):
+  """Yields every file below a directory with os.scandir.
+
+  Args:
+    directory: The path to the directory.
+
+  Yields:
+    os.DirEntry objects for the regular files.
+  """
+
+  with os.scandir(directory) as entries:
+    for entry in entries:
+      if entry.is_dir(follow_symlinks=False):
+        yield from IterFiles(entry.path)
+      elif entry.is_file(follow_symlinks=False) and entry.name != INDEX_FILE_NAME:
+        yield entry
+
+def LoadIndex(index_path):
+  """Loads a format index written by ScanDirectory.
+
+  Args:
+    index_path: The path to the index file.
+
+  Returns:
+    A dict of entries keyed by path relative to the scanned directory, empty if the index does not exist or cannot be read.
+  """
+
+  try:
+    with open(index_path, "r", encoding="utf-8") as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+def ScanDirectory(directory, index_path=None, save=True):
+  """Classifies every file below a directory, reusing a cached index.
+
+  Files whose size and modification time match the cached entry are not
+  opened at all; the others are classified from their first bytes.
+
+  Args:
+    directory: The path to the directory.
+    index_path: The path to the index file, or None for INDEX_FILE_NAME in the directory.
+    save: Whether to write the updated index back.
+
+  Returns:
+    A tuple of the index (entries keyed by path relative to the directory,
+    each with size, mtime_ns and the fields from ClassifyHeader) and the
+    number of files that had to be read.
+  """
+
+  if index_path is None:
+    index_path = os.path.join(directory, INDEX_FILE_NAME)
+
+  cached = LoadIndex(index_path)
+  index = {}
+  read = 0
+
+  for file in IterFiles(directory):
+    stat = file.stat(follow_symlinks=False)
+    # Relative keys keep the cache valid however the directory is spelled.
+    key = os.path.relpath(file.path, directory)
+    entry = cached.get(key)
+
+    if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+      try:
+        entry = SniffHeader(file.path, stat.st_size)
+      except OSError:
+        continue
+      entry["size"] = stat.st_size
+      entry["mtime_ns"] = stat.st_mtime_ns
+      read += 1
+
+    index[key] = entry
+
+  if save:
+    with open(index_path, "w", encoding="utf-8") as f:
+      json.dump(index, f, indent=1)
+
+  return index, read
+
+def PrintIndexSummary(index, read):
+  """Prints a per-kind summary of a format index.
+
+  Args:
+    index: The index returned by ScanDirectory.
+    read: The number of files that had to be read.
+  """
+
+  counts = {}
+  sizes = {}
+  for entry in index.values():
+    counts[entry["kind"]] = counts.get(entry["kind"], 0) + 1
+    sizes[entry["kind"]] = sizes.get(entry["kind"], 0) + entry["size"]
+
+  for kind in sorted(counts):
+    print(f"{kind}: {counts[kind]} files, {sizes[kind]} bytes")
+  print_message(f"Indexed {len(index)} files ({read} read, {len(index) - read} unchanged).")
+
+def ReadArchiveEntries(f, size):
+  """Reads the entry table of a simple archive.
+
+  Uses the same checks as UnpackSimpleArchive: a count from 1 to
+  ARCHIVE_MAX_ENTRIES and entries that fit in the file. Stage containers
+  are not simple archives and give None.
+
+  Args:
+    f: The archive, opened in binary mode.
+    size: The size of the archive.
+
+  Returns:
+    A list of (offset, size) tuples, or None if f is not a simple archive.
+  """
+
+  if size < 16:
+    return None
+  f.seek(0)
+  count, check_unk, check_zero = struct.unpack("<Iiq", f.read(16))
+  if count == 0 or count > ARCHIVE_MAX_ENTRIES or 4 + count * 8 > size:
+    return None
+  if check_unk < 9999 and check_zero == 0:
+    return None
+
+  f.seek(4)
+  table = struct.unpack(f"<{count * 2}I", f.read(count * 8))
+  entries = list(zip(table[0::2], table[1::2]))
+  if sum(entry_size for offset, entry_size in entries) + 4 > size:
+    return None
+  if any(offset + entry_size > size for offset, entry_size in entries):
+    return None
+  return entries
+
+def InventoryJPK(path, index=None):
+  """Lists the JPK data in a file or directory tree from the JKR headers alone.
+
+  Standalone JKR files are taken from the format index where possible, so
+  unchanged files are not opened. Other files are checked for a simple
+  archive table, and the entries of a simple archive that start with a JKR
+  header are listed too. Nothing is decoded.
+
+  Args:
+    path: The path to a file or a directory.
+    index: A format index from ScanDirectory for the directory, or None to scan it (without saving).
+
+  Returns:
+    A list of dicts with the path, the archive entry index (None for a
+    standalone file), the offset, the compressed size, the JKR header
+    fields and the ratio of compressed to decoded size, largest decoded
+    size first.
+  """
+
+  if os.path.isdir(path):
+    directory = path
+    if index is None:
+      index, read = ScanDirectory(path, save=False)
+  else:
+    directory, name = os.path.split(path)
+    index = {name: SniffHeader(path)}
+    index[name]["size"] = os.path.getsize(path)
+
+  rows = []
+  def AddRow(file_path, entry, offset, size, header):
+    rows.append({
+      "path": file_path,
+      "entry": entry,
+      "offset": offset,
+      "size": size,
+      "type": header["type"],
+      "version": header["version"],
+      "start_offset": header["start_offset"],
+      "out_size": header["out_size"],
+      "ratio": size / header["out_size"] if header["out_size"] else 0.0,
+    })
+
+  for key, info in index.items():
+    file_path = os.path.join(directory, key)
+    if info["kind"] == "jkr" and "type" in info:
+      AddRow(file_path, None, 0, info["size"], info)
+    elif info["kind"] == "unknown":
+      try:
+        with open(file_path, "rb") as f:
+          entries = ReadArchiveEntries(f, info["size"])
+          for i, (offset, size) in enumerate(entries or ()):
+            if size >= JPK_HEADER_SIZE:
+              header = ReadJPKHeader(f, offset)
+              if header is not None:
+                AddRow(file_path, i, offset, size, header)
+      except OSError:
+        continue
+
+  rows.sort(key=lambda row: row["out_size"], reverse=True)
+  return rows
+
+def PrintJPKInventory(rows, csv_path=JPK_INVENTORY_PATH):
+  """Prints a per-type summary of a JPK inventory and writes it to a CSV file.
+
+  Args:
+    rows: The rows returned by InventoryJPK.
+    csv_path: The path to the CSV file, or None to only print the summary.
+  """
+
+  if csv_path is not None:
+    if os.path.dirname(csv_path):
+      os.makedirs(os.path.dirname(csv_path), exist_ok=True)
+    with open(csv_path, "w", newline="", encoding="utf-8") as f:
+      writer = csv.DictWriter(f, fieldnames=["path", "entry", "offset", "size", "type", "version", "start_offset", "out_size", "ratio"])
+      writer.writeheader()
+      writer.writerows(rows)
+
+  counts = {}
+  sizes = {}
+  out_sizes = {}
+  for row in rows:
+    counts[row["type"]] = counts.get(row["type"], 0) + 1
+    sizes[row["type"]] = sizes.get(row["type"], 0) + row["size"]
+    out_sizes[row["type"]] = out_sizes.get(row["type"], 0) + row["out_size"]
+
+  for type in sorted(counts):
+    ratio = sizes[type] / out_sizes[type] if out_sizes[type] else 0.0
+    print(f"type {type}: {counts[type]} files, {sizes[type]} bytes compressed, {out_sizes[type]} bytes decoded ({ratio:.2%})")
+  if rows:
+    print(f"Largest: {rows[0]['path']}" + (f" entry {rows[0]['entry']}" if rows[0]["entry"] is not None else "") + f" ({rows[0]['out_size']} bytes decoded)")
+  print_message(f"Found {len(rows)} JKR headers" + (f", written to {csv_path}." if csv_path is not None else "."))
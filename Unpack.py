@@ -1,7 +1,9 @@
 import io
 import os
+import mmap
 from Libraries import *
 from JPK import *
+from Scanner import ClassifyHeader
 
 import io
 import os
@@ -181,78 +183,101 @@ def UnpackMHA(input, brInput, createLog=True):
 
 
 
-def UnpackJPK(input_file):
+def UnpackJPK(input_file, stats=None):
   """Unpacks a JPK file.
 
+  The compressed file is memory-mapped, and the output file is created at
+  its decoded size (out_size from the header) and memory-mapped too, so
+  the decoders write straight into it without an in-memory copy. With a
+  JPKStats, the output is streamed through DecodeToSink instead, so the
+  progress can be reported as each chunk is written.
+
+  If the data cannot be decoded, or decodes to a size other than out_size,
+  the partial output is removed and the input file is kept.
+
   Args:
     input_file: The path to the input JPK file.
-  """
+    stats: A JPKStats to report the progress and throughput to, or None.
 
-  buffer = open(input_file, "rb").read()
-  ms = io.BytesIO(buffer)
-  br = io.BufferedReader(ms)
+  Returns:
+    True if the file was decompressed and replaced, False otherwise.
+  """
 
-  # Check the magic number.
-  if br.readuint32() != 0x1A524B4A:
-    return
+  if os.path.getsize(input_file) < JPK_HEADER_SIZE:
+    return False
+
+  with open(input_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+    # Check the magic number and read the header.
+    jpk_header = ParseJPKHeader(mm)
+    if jpk_header is None:
+      return False
+
+    # Read the JPK type.
+    type = jpk_header["type"]
+    print(f"JPK Type: {type}")
+
+    # Select the appropriate decoder based on the JPK type.
+    decoder = None
+    if type == 0:
+      decoder = JPKDecodeRW()
+    elif type == 2:
+      decoder = JPKDecodeHFIRW()
+    elif type == 3:
+      decoder = JPKDecodeLz()
+    elif type == 4:
+      decoder = JPKDecodeHFI()
+
+    if decoder is None:
+      return False
 
-  # Read the JPK type.
-  ms.seek(0x2, io.SEEK_CUR)
-  type = br.readuint16()
-  print(f"JPK Type: {type}")
-
-  # Select the appropriate decoder based on the JPK type.
-  decoder = None
-  if type == 0:
-    decoder = JPKDecodeRW()
-  elif type == 2:
-    decoder = JPKDecodeHFIRW()
-  elif type == 3:
-    decoder = JPKDecodeLz()
-  elif type == 4:
-    decoder = JPKDecodeHFI()
-
-  # If a decoder was selected, decompress the file.
-  if decoder is not None:
     # Read the start offset and output size.
-    start_offset = br.readint32()
-    out_size = br.readint32()
-
-    # Create a buffer to store the decompressed data.
-    out_buffer = bytearray(out_size)
-
-    # Seek to the start of the compressed data.
-    ms.seek(start_offset, io.SEEK_SET)
-
-    # Decompress the data.
-    decoder.ProcessOnDecode(ms, out_buffer)
-
-    # Get the extension of the decompressed file.
-    extension = None
-    header = out_buffer[:4]
-    header_int = int.from_bytes(header, byteorder="big")
-    if header_int in Extensions:
-      extension = Extensions(header_int)
-    elif CheckForMagic(header_int, out_buffer) is not None:
-      extension = CheckForMagic(header_int, out_buffer)
-    else:
-      extension = "bin"
-
-    # Get the output path for the decompressed file.
-    file_info = os.path.splitext(input_file)
-    directory = file_info[0]
-    filename = file_info[1]
-    output_path = f"{directory}/{filename}.{extension}"
-
-    # Delete the input file.
-    os.remove(input_file)
-
-    # Write the decompressed data to the output file.
-    open(output_path, "wb").write(out_buffer)
-
-  # Close the BinaryReader and MemoryStream objects.
-  br.close()
-  ms.close()
+    start_offset, out_size = jpk_header["start_offset"], jpk_header["out_size"]
+
+    # Decompress the data into a temporary file of the decoded size,
+    # keeping its first bytes to pick the extension.
+    base_path = os.path.splitext(input_file)[0]
+    part_path = f"{base_path}.part"
+    header = b""
+    decoded = 0
+    success = False
+    try:
+      with open(part_path, "w+b") as out:
+        if stats is not None:
+          stats.Begin("decode", type, len(mm) - start_offset)
+          decoded = decoder.DecodeToSink(mm, out_size, stats.WrapSink(out.write, out_size), start_offset)
+          stats.End(len(mm) - start_offset, decoded)
+
+          out.seek(0)
+          header = out.read(16)
+
+        elif out_size > 0:
+          out.truncate(out_size)
+          with mmap.mmap(out.fileno(), out_size, access=mmap.ACCESS_WRITE) as out_mm:
+            decoded = decoder.DecodeInto(mm, out_mm, start_offset)
+            header = out_mm[:16]
+            out_mm.flush()
+
+      if decoded == out_size:
+        success = True
+      else:
+        print(f"ERROR: {input_file} decoded to {decoded} bytes instead of {out_size}. Keeping the input file.")
+    except Exception as e:
+      print(f"ERROR: Could not decode {input_file}: {e!r}. Keeping the input file.")
+    finally:
+      # Do not leave a partial output behind.
+      if not success and os.path.exists(part_path):
+        os.remove(part_path)
+
+    if not success:
+      return False
+
+  # Get the extension of the decompressed file.
+  extension = ClassifyHeader(header, out_size)["extension"] or "bin"
+
+  # Replace the input file with the decompressed file.
+  os.remove(input_file)
+  os.replace(part_path, f"{base_path}.{extension}")
+  return True
 
 
 